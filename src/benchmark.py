@@ -0,0 +1,230 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Offline render benchmark. A synthetic source video is generated with
+# ffmpeg's testsrc and a fixed word timeline stands in for the transcript, so
+# every run measures the same work without downloads, LLM calls or Whisper.
+# Each stage is timed separately and the result is written as JSON.
+#
+#   python benchmark.py
+#   python benchmark.py 2 --duration 60 --output output/benchmark.json
+
+SENTENCES = (
+    "this is the part nobody tells you about building things",
+    "you start with a simple idea and it grows every single week",
+    "then one day you look back and realise how far you have come",
+    "so keep going even when it feels slow",
+)
+WORD_SECONDS = 0.32
+SENTENCE_PAUSE = 0.6
+
+
+def word_timeline(duration):
+    # Whisper shaped [{"word", "start", "end"}] covering duration seconds
+    words = []
+    t = 0.2
+    while True:
+        for sentence in SENTENCES:
+            for word in sentence.split():
+                if t + WORD_SECONDS > duration:
+                    return words
+                words.append(
+                    {"word": word, "start": round(t, 2), "end": round(t + WORD_SECONDS - 0.04, 2)}
+                )
+                t += WORD_SECONDS
+            t += SENTENCE_PAUSE
+
+
+def make_source(path, duration, size, fps):
+    # H.264 with a keyframe every two seconds and an AAC tone, like a
+    # downloaded source
+    subprocess.run(
+        [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"testsrc=size={size}:rate={fps}:duration={duration}",
+            "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+            "-c:v", "libx264", "-preset", "veryfast", "-g", str(2 * fps),
+            "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest", path,
+        ],
+        check=True,
+    )
+
+
+def max_rss_mb():
+    # ru_maxrss of this process and of its waited for children such as
+    # ffmpeg, None where the platform has no getrusage. These are lifetime
+    # high water marks, after a stage they are the maximum of that stage and
+    # every stage before it, not the stage's own peak.
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale,
+    )
+
+
+def run_stage(name, fn, repeat=1):
+    # fn returns a dict of extra numbers for the report, or None. A stage
+    # that fails, e.g. without ffprobe or a font, is recorded and the other
+    # stages still run.
+    print(f"Benchmarking {name}")
+    try:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            extra = fn()
+        seconds = (time.perf_counter() - started) / repeat
+    except ImportError as e:
+        print(f"Skipping {name}: {e}")
+        return {"skipped": str(e)}
+    except Exception as e:
+        print(f"Failed {name}: {type(e).__name__}: {e}")
+        return {"failed": f"{type(e).__name__}: {e}"}
+    max_rss, children_max_rss = max_rss_mb()
+    stage = {"seconds": round(seconds, 6), "repeat": repeat}
+    stage.update(extra or {})
+    stage["max_rss_so_far_mb"] = max_rss and round(max_rss, 1)
+    stage["children_max_rss_so_far_mb"] = children_max_rss and round(children_max_rss, 1)
+    return stage
+
+
+def run_benchmark(config, directory, duration=30, size="1920x1080", fps=30, repeat=5):
+    from helper_cut import cut_clips
+    from helper_transcribe import SAMPLING_RATE, load_audio
+    from helper_video import get_output_geometry
+    from helper_compositor import build_caption_layers
+    from helper_subtitle import (
+        add_subtitles,
+        create_caption,
+        get_font_config,
+        split_text_into_lines,
+    )
+
+    source = os.path.join(directory, "source.mp4")
+    make_source(source, duration, size, fps)
+    wordlevel_info = word_timeline(duration)
+    subtitle_config = config.get("subtitle_config") or {}
+    font_config = get_font_config(config)
+    # The synthetic source is not probed, its size is known and the stages
+    # should not need ffprobe
+    width, height = (int(value) for value in size.split("x"))
+    geometry = get_output_geometry(
+        width,
+        height,
+        config.get("output_resolution", "1080p"),
+        config.get("video_aspect_ratio", [9, 16]),
+    )
+    frame_size = (geometry["width"], geometry["height"])
+    lines = split_text_into_lines(wordlevel_info, subtitle_config)
+
+    def split():
+        return {"words": len(wordlevel_info), "lines": len(split_text_into_lines(wordlevel_info, subtitle_config))}
+
+    def captions():
+        for line in lines:
+            create_caption(line, frame_size, config)
+        return {"lines": len(lines)}
+
+    def layers():
+        return {"layers": len(build_caption_layers(lines, frame_size, font_config))}
+
+    def cut():
+        # Back to back clips over the whole source, as download_and_trim cuts
+        # them
+        clip_seconds = max(duration // 4, 1)
+        cuts = [
+            (os.path.join(directory, f"cut_{index}.mp4"), start, min(start + clip_seconds, duration))
+            for index, start in enumerate(range(0, duration, clip_seconds))
+        ]
+        failed = cut_clips(
+            source, cuts, config.get("cut_workers", 4), config.get("cut_mode", "copy")
+        )
+        if failed:
+            raise RuntimeError(f"Failed to cut {failed}")
+        return {"clips": len(cuts), "cut_mode": config.get("cut_mode", "copy")}
+
+    def decode_audio():
+        # The PCM Whisper is fed, decoded without an intermediate file
+        samples = load_audio(source)
+        if not len(samples):
+            raise RuntimeError("No audio decoded")
+        return {"samples": len(samples), "audio_seconds": round(len(samples) / SAMPLING_RATE, 2)}
+
+    def render():
+        # A list of stats when the config has several output variants
+        stats = add_subtitles(source, lines, config) or {}
+        if isinstance(stats, list):
+            return {"frames": sum(item["frames"] for item in stats), "outputs": len(stats)}
+        return {"frames": stats.get("frames") or int(round(duration * fps))}
+
+    stages = {
+        "split_text_into_lines": run_stage("split_text_into_lines", split, repeat),
+        "create_caption": run_stage("create_caption", captions),
+        "build_caption_layers": run_stage("build_caption_layers", layers),
+        "cut_clips": run_stage("cut_clips", cut),
+        "load_audio": run_stage("load_audio", decode_audio),
+        "add_subtitles": run_stage("add_subtitles", render),
+    }
+    render_stage = stages["add_subtitles"]
+    if render_stage.get("seconds"):
+        render_stage["fps"] = round(render_stage["frames"] / render_stage["seconds"], 2)
+    return stages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the pipeline stages on a synthetic clip")
+    parser.add_argument("config_id", nargs="?", default="1")
+    parser.add_argument("--duration", type=int, default=30, help="seconds of synthetic video")
+    parser.add_argument("--size", default="1920x1080", help="synthetic source size")
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=5, help="runs of the fast stages")
+    parser.add_argument("--backend", help="render_backend to benchmark instead of the config's")
+    parser.add_argument("--output", help="also write the JSON report here")
+    args = parser.parse_args(argv)
+
+    with open("./config.json") as f:
+        config = dict(json.load(f)[args.config_id])
+    # Renders land in output/benchmark, never next to real clips
+    config["name"] = "benchmark"
+    if args.backend:
+        config["render_backend"] = args.backend
+
+    directory = tempfile.mkdtemp(prefix="reelmaker-benchmark-")
+    try:
+        stages = run_benchmark(config, directory, args.duration, args.size, args.fps, args.repeat)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        "config_id": args.config_id,
+        "render_backend": config.get("render_backend", "numpy"),
+        "duration": args.duration,
+        "size": args.size,
+        "fps": args.fps,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "stages": stages,
+    }
+    text = json.dumps(report, indent=4)
+    print(text)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
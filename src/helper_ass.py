@@ -0,0 +1,241 @@
+import os
+
+import ffmpeg
+from PIL import ImageColor
+
+import helper_metrics as metrics
+from helper_glyph import get_font, resolve_font_path, measure_word
+from helper_lines import expand_subtitles
+from helper_caption import (
+    get_caption_styles,
+    layout_caption,
+    get_highlight_size,
+    place_line,
+)
+from helper_video import get_crop_box, get_encoder_config, COPYABLE_AUDIO_CODECS
+
+# Captions rendered as Advanced SubStation Alpha events and burnt in by
+# ffmpeg's ass filter, so Python does no work per frame. Layout comes from the
+# same glyph measurements as the numpy renderer and every element is placed
+# with \pos and clipped to its line box.
+
+ASS_HEADER = """[Script Info]
+ScriptType: v4.00+
+PlayResX: {width}
+PlayResY: {height}
+WrapStyle: 2
+ScaledBorderAndShadow: yes
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+{styles}
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+
+
+def ass_supported(font_config):
+    # ASS has no per word random rotation, those configs need a raster
+    # backend. Font config "2" is the shipped config without it.
+    return not font_config["highlighted"].get("rotate_random_degree")
+
+
+def ass_color(color, opacity=1):
+    if isinstance(color, str):
+        color = ImageColor.getrgb(color)
+    r, g, b = color[:3]
+    alpha = int(round(255 * (1 - opacity)))
+    return f"&H{alpha:02X}{b:02X}{g:02X}{r:02X}"
+
+
+def ass_time(seconds):
+    centiseconds = int(round(max(seconds, 0) * 100))
+    hours, centiseconds = divmod(centiseconds, 360000)
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    seconds, centiseconds = divmod(centiseconds, 100)
+    return f"{hours}:{minutes:02d}:{seconds:02d}.{centiseconds:02d}"
+
+
+def ass_text(text):
+    # Braces start override blocks and leading spaces would be trimmed
+    text = text.replace("\\", "/").replace("{", "(").replace("}", ")")
+    return text.replace(" ", "\\h")
+
+
+def ass_style(name, style):
+    font_name, size, color, stroke_color, stroke_width = style
+    font = get_font(font_name, size)
+    family, face = font.getname()
+    fontname = family if face in ("Regular", "Normal", "Book") else f"{family} {face}"
+    # ASS font sizes are line heights rather than em sizes
+    ascent, descent = font.getmetrics()
+    outline = stroke_width if stroke_color else 0
+    return (
+        f"Style: {name},{fontname},{ascent + descent},{ass_color(color)},"
+        f"{ass_color(color)},{ass_color(stroke_color or 'black')},&H00000000,"
+        f"0,0,0,0,100,100,0,0,1,{outline},0,7,0,0,0,1"
+    )
+
+
+def ass_fill(color, opacity):
+    color = ass_color(color, opacity)
+    return f"\\1c&H{color[4:]}&\\1a&H{color[2:4]}&"
+
+
+def rounded_rectangle_path(width, height, radius):
+    r = max(0, min(radius, width / 2, height / 2))
+    w, h = width, height
+    if not r:
+        return f"m 0 0 l {w:g} 0 {w:g} {h:g} 0 {h:g}"
+    return (
+        f"m {r:g} 0 l {w - r:g} 0 b {w:g} 0 {w:g} 0 {w:g} {r:g} "
+        f"l {w:g} {h - r:g} b {w:g} {h:g} {w:g} {h:g} {w - r:g} {h:g} "
+        f"l {r:g} {h:g} b 0 {h:g} 0 {h:g} 0 {h - r:g} "
+        f"l 0 {r:g} b 0 0 0 0 {r:g} 0"
+    )
+
+
+def dialogue(layer, start, end, style, text):
+    return f"Dialogue: {layer},{ass_time(start)},{ass_time(end)},{style},,0,0,0,,{text}"
+
+
+def build_ass(linelevel_subtitles, frame_size, font_config):
+    styles = get_caption_styles(frame_size, font_config)
+    highlighted = font_config["highlighted"]
+    highlight_background = highlighted["back_ground_color_clip"]
+    # Glyph bitmaps are padded by the stroke, ASS positions the glyphs
+    normal_stroke = styles["normal"][4] and int(round(styles["normal"][4]))
+    stroke = styles["highlighted"][4] and int(round(styles["highlighted"][4]))
+
+    header = ASS_HEADER.format(
+        width=frame_size[0],
+        height=frame_size[1],
+        styles="\n".join(
+            [
+                ass_style("Normal", styles["normal"]),
+                ass_style("Highlighted", styles["highlighted"]),
+            ]
+        ),
+    )
+    events = []
+    for line in expand_subtitles(linelevel_subtitles):
+        positions = layout_caption(line, frame_size, font_config)
+        if not positions:
+            continue
+        placement = place_line(positions, frame_size, font_config)
+        line_x, line_y = placement["x"], placement["y"]
+        clip = "\\clip({},{},{},{})".format(*placement["bounds"])
+
+        if font_config["background"]["opacity"] > 0:
+            fill = ass_fill(
+                font_config["background"]["color"], font_config["background"]["opacity"]
+            )
+            events.append(
+                dialogue(
+                    0,
+                    line["start"],
+                    line["end"],
+                    "Normal",
+                    f"{{\\an7\\pos({line_x},{line_y}){clip}\\bord0\\shad0"
+                    f"{fill}\\p1}}"
+                    f"{rounded_rectangle_path(placement['width'], placement['height'], 0)}",
+                )
+            )
+
+        for position in positions:
+            events.append(
+                dialogue(
+                    1,
+                    position["normal_start"],
+                    position["normal_start"] + position["normal_duration"],
+                    "Normal",
+                    f"{{\\an7\\pos({line_x + position['x_pos'] + normal_stroke},"
+                    f"{line_y + position['y_pos'] + normal_stroke}){clip}}}"
+                    f"{ass_text(position['word'])}",
+                )
+            )
+
+        for position in positions:
+            x = line_x + position["x_pos"]
+            y = line_y + position["y_pos"]
+            width, height = get_highlight_size(position, font_config)
+            if highlight_background["opacity"] > 0:
+                fill = ass_fill(
+                    highlight_background["color"], highlight_background["opacity"]
+                )
+                events.append(
+                    dialogue(
+                        2,
+                        position["start"],
+                        position["end"],
+                        "Highlighted",
+                        f"{{\\an7\\pos({x},{y}){clip}\\bord0\\shad0"
+                        f"{fill}\\p1}}"
+                        f"{rounded_rectangle_path(width, height, highlight_background['radius'])}",
+                    )
+                )
+            # Centre the highlighted word in its background like the sprite does
+            word_width, word_height = measure_word(
+                position["word"], styles["highlighted"]
+            )
+            text_x = x + (width - word_width) // 2 + stroke
+            text_y = y + (height - word_height) // 2 + stroke
+            events.append(
+                dialogue(
+                    3,
+                    position["start"],
+                    position["end"],
+                    "Highlighted",
+                    f"{{\\an7\\pos({text_x},{text_y}){clip}}}{ass_text(position['word'])}",
+                )
+            )
+
+    return header + "\n".join(events) + "\n"
+
+
+def write_ass(ass_path, linelevel_subtitles, frame_size, font_config):
+    os.makedirs(os.path.dirname(ass_path), exist_ok=True)
+    with open(ass_path, "w", encoding="utf-8") as f:
+        f.write(build_ass(linelevel_subtitles, frame_size, font_config))
+    return ass_path
+
+
+def burn_ass(video_path, output_path, ass_path, info, geometry, font_config, config):
+    # One ffmpeg encode: crop, scale, burn the subtitles and mux the audio
+    encoder_config = get_encoder_config(config, info)
+    crop_width, crop_height, crop_x, crop_y = get_crop_box(info, geometry)
+
+    input_stream = ffmpeg.input(video_path)
+    video = input_stream.video.filter("crop", crop_width, crop_height, crop_x, crop_y)
+    video = video.filter("scale", geometry["width"], geometry["height"], flags="bicubic")
+    if config.get("encoder_config", {}).get("fps"):
+        video = video.filter("fps", encoder_config["fps"])
+    video = video.filter(
+        "ass",
+        ass_path,
+        fontsdir=os.path.dirname(resolve_font_path(font_config["normal"]["font"])),
+    )
+
+    streams = [video]
+    output_args = {
+        "vcodec": "libx264",
+        "preset": encoder_config["preset"],
+        "crf": encoder_config["crf"],
+        "pix_fmt": "yuv420p",
+        "movflags": "+faststart",
+        "loglevel": "error",
+    }
+    if encoder_config["threads"]:
+        output_args["threads"] = encoder_config["threads"]
+    if info["audio_codec"]:
+        streams.append(input_stream.audio)
+        output_args["acodec"] = (
+            "copy" if info["audio_codec"] in COPYABLE_AUDIO_CODECS else "aac"
+        )
+
+    output_stream = ffmpeg.output(*streams, output_path, **output_args)
+    output_stream = ffmpeg.overwrite_output(output_stream)
+    metrics.count("ffmpeg_processes")
+    ffmpeg.run(output_stream)
+    print(f"Burnt in ASS subtitles: {output_path}")
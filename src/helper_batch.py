@@ -0,0 +1,143 @@
+import os
+import sys
+import time
+import queue
+import traceback
+import multiprocessing
+
+# A small process pool that keeps going when a task raises or a worker dies.
+# multiprocessing.Pool hangs when a worker is killed (for example by the OOM
+# killer) and concurrent.futures fails every pending task. Here the parent
+# hands out one task at a time per worker, so it always knows which task a
+# dead worker was running and only that one is marked as crashed.
+
+
+def get_context():
+    # fork keeps already loaded fonts and models shared copy-on-write
+    if sys.platform.startswith("linux"):
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+
+def available_memory_mb():
+    # Memory the kernel can hand out without swapping, None where unknown
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def fit_workers(workers, memory_mb):
+    # As many of workers as fit in the available memory at memory_mb each
+    if not memory_mb or workers <= 1:
+        return workers
+    available = available_memory_mb()
+    if available is None:
+        return workers
+    return max(1, min(workers, int(available // memory_mb)))
+
+
+def run_task(function, item):
+    started = time.time()
+    try:
+        record = {"status": "ok", "result": function(item)}
+    except Exception as e:
+        record = {
+            "status": "failed",
+            "error": f"{type(e).__name__}: {e}",
+            "traceback": traceback.format_exc(),
+        }
+    record["seconds"] = time.time() - started
+    return record
+
+
+def _worker(function, initializer, initargs, tasks, results):
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        index, item = task
+        results.put((index, os.getpid(), run_task(function, item)))
+
+
+def run_in_workers(function, items, workers, initializer=None, initargs=(), max_tasks_per_worker=None):
+    # Returns one record per item, in order, with status "ok", "failed" or
+    # "crashed", the wall time in seconds and the result or error. Workers are
+    # replaced after max_tasks_per_worker items to bound their memory.
+    context = get_context()
+    results = context.Queue()
+    records = [None] * len(items)
+    remaining = len(items)
+    next_item = 0
+    active = {}
+    retired = []
+
+    def assign(worker):
+        nonlocal next_item
+        if next_item < len(items) and (
+            max_tasks_per_worker is None or worker["done"] < max_tasks_per_worker
+        ):
+            worker["tasks"].put((next_item, items[next_item]))
+            worker["index"] = next_item
+            worker["started"] = time.time()
+            next_item += 1
+        else:
+            worker["tasks"].put(None)
+            retired.append(active.pop(worker["process"].pid)["process"])
+
+    def spawn():
+        tasks = context.Queue()
+        process = context.Process(
+            target=_worker,
+            args=(function, initializer, initargs, tasks, results),
+            daemon=True,
+        )
+        process.start()
+        worker = {"process": process, "tasks": tasks, "done": 0}
+        active[process.pid] = worker
+        assign(worker)
+
+    while remaining:
+        while len(active) < workers and next_item < len(items):
+            spawn()
+
+        try:
+            index, pid, record = results.get(timeout=1)
+        except queue.Empty:
+            # Only look for dead workers once the queue is drained, so results
+            # a worker sent just before exiting are never mistaken for a crash
+            for pid, worker in list(active.items()):
+                if worker["process"].is_alive():
+                    continue
+                del active[pid]
+                retired.append(worker["process"])
+                records[worker["index"]] = {
+                    "status": "crashed",
+                    "error": f"Worker exited with code {worker['process'].exitcode}",
+                    "seconds": time.time() - worker["started"],
+                }
+                remaining -= 1
+            continue
+
+        records[index] = record
+        remaining -= 1
+        worker = active.get(pid)
+        if worker is not None:
+            worker["done"] += 1
+            assign(worker)
+
+    for worker in list(active.values()):
+        worker["tasks"].put(None)
+        retired.append(worker["process"])
+    for process in retired:
+        process.join()
+    return records
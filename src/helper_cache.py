@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+# Content-addressed artifact cache shared by every run. Entries are keyed by a
+# hash of everything that went into producing them (video id, prompt, model,
+# config blobs, the keys of upstream artifacts), so changing any input only
+# recomputes the stages downstream of it. An entry's mtime is when it was
+# written, used for max_age, and hits set its atime, so eviction can remove
+# the least recently used entries once the cache is too big.
+
+CACHE_DIR = os.path.join(os.getcwd(), "output", ".cache")
+DEFAULT_MAX_GB = 20
+
+
+def hash_key(*parts):
+    blob = json.dumps(parts, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def entry_path(stage, key, suffix=""):
+    return os.path.join(CACHE_DIR, stage, key[:2], key + suffix)
+
+
+def _touch(path, stat):
+    try:
+        os.utime(path, (time.time(), stat.st_mtime))
+    except OSError:
+        pass
+
+
+def lookup(stage, key, suffix="", max_age=None):
+    # max_age in seconds, older entries count as missing
+    path = entry_path(stage, key, suffix)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if max_age is not None and time.time() - stat.st_mtime > max_age:
+        return None
+    _touch(path, stat)
+    return path
+
+
+def _tmp_path(path):
+    return f"{path}.{os.getpid()}.tmp"
+
+
+def store_file(stage, key, source_path, suffix=""):
+    path = entry_path(stage, key, suffix)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = _tmp_path(path)
+    shutil.copyfile(source_path, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def restore_file(stage, key, destination, suffix=""):
+    # Copy a cached file out, never link, outputs get overwritten in place
+    path = lookup(stage, key, suffix)
+    if path is None:
+        return False
+    os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+    tmp_path = _tmp_path(destination)
+    shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, destination)
+    return True
+
+
+def load_json(stage, key, max_age=None):
+    path = lookup(stage, key, ".json", max_age)
+    if path is None:
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def store_json(stage, key, value):
+    path = entry_path(stage, key, ".json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, "w") as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+    return value
+
+
+def cached_json(stage, key, compute, max_age=None):
+    value = load_json(stage, key, max_age)
+    if value is None:
+        value = store_json(stage, key, compute())
+    else:
+        print(f"Using cached {stage} ({key[:12]})")
+    return value
+
+
+def evict(max_gb=DEFAULT_MAX_GB, stage=None):
+    # Least recently used first, over the whole cache or a single stage
+    entries = []
+    total = 0
+    for root, _, files in os.walk(os.path.join(CACHE_DIR, stage) if stage else CACHE_DIR):
+        for file in files:
+            path = os.path.join(root, file)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if file.endswith(".tmp") and stat.st_mtime > time.time() - 3600:
+                # Being written by another process
+                continue
+            entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path))
+            total += stat.st_size
+
+    max_bytes = max_gb * 1024 ** 3
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    if removed:
+        print(f"Evicted {removed} cache entries")
+    return removed
+
+
+def manifest_path(name):
+    return os.path.join(os.getcwd(), "output", name, "manifest.json")
+
+
+def load_manifest(name):
+    path = manifest_path(name)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def update_manifest(name, **stages):
+    # The manifest records which cache key each stage of the last run used
+    manifest = load_manifest(name)
+    manifest.update(stages)
+    path = manifest_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
@@ -0,0 +1,130 @@
+from helper_glyph import (
+    get_style,
+    measure_word,
+    highlight_angle,
+    render_rotated_highlight,
+)
+
+
+def get_caption_styles(frame_size, font_config):
+    fontsize = int(frame_size[1] * font_config["font_size_factor"])
+    return {
+        "fontsize": fontsize,
+        "normal": get_style(font_config["normal"], fontsize),
+        "spacing": get_style(font_config["spacing"], fontsize),
+        "highlighted": get_style(font_config["highlighted"], fontsize),
+    }
+
+
+def layout_caption(text_json, frame_size, font_config):
+    # Word positions of a subtitle line, relative to the top left of the line
+    styles = get_caption_styles(frame_size, font_config)
+
+    full_duration = text_json["end"] - text_json["start"]
+    frame_width = frame_size[0]
+
+    x_buffer = frame_width * 1 / 10
+    max_line_width = frame_width - 2 * (x_buffer)
+
+    space_width, _ = measure_word(font_config["spacing"]["text"], styles["spacing"])
+
+    x_pos = 0
+    y_pos = 0
+    line_width = 0  # Total width of words in the current line
+    xy_textclips_positions = []
+
+    for word_json in text_json["textcontents"]:
+        word = word_json["word"]
+        if font_config["uppercase"]:
+            word = word.upper()
+
+        normal_word_duration = full_duration
+        normal_word_start = text_json["start"]
+        if font_config["words_on_the_go"]:
+            normal_word_duration = text_json["end"] - word_json["end"]
+            normal_word_start = word_json["end"]
+
+        word_width, word_height = measure_word(word, styles["normal"])
+        if line_width + word_width + space_width > max_line_width:
+            # Move to the next line
+            x_pos = 0
+            y_pos = y_pos + word_height + 10
+            line_width = 0
+
+        xy_textclips_positions.append(
+            {
+                "x_pos": x_pos,
+                "y_pos": y_pos,
+                "width": word_width,
+                "height": word_height,
+                "word": word,
+                "start": word_json["start"],
+                "end": word_json["end"],
+                "duration": word_json["end"] - word_json["start"],
+                "normal_start": normal_word_start,
+                "normal_duration": normal_word_duration,
+            }
+        )
+
+        x_pos = x_pos + word_width + space_width
+        line_width = line_width + word_width + space_width
+
+    return xy_textclips_positions
+
+
+def get_highlight_size(position, font_config):
+    return (
+        int(position["width"] * 1.1 * font_config["highlighted"]["font_size_factor"]),
+        int(position["height"] * 1.1 * font_config["highlighted"]["font_size_factor"]),
+    )
+
+
+def get_highlight_background(font_config):
+    background = font_config["highlighted"]["back_ground_color_clip"]
+    return (tuple(background["color"]), background["opacity"], background["radius"])
+
+
+def get_highlight_sprite(position, style, font_config):
+    # (sprite, x, y) of a highlighted word, relative to the top left of the
+    # line. A rotated sprite is larger than the box, it is moved so the box
+    # stays centred on the word.
+    size = get_highlight_size(position, font_config)
+    angle = highlight_angle(
+        position["word"],
+        position["start"],
+        font_config["highlighted"].get("rotate_random_degree"),
+    )
+    sprite = render_rotated_highlight(
+        position["word"], size, style, get_highlight_background(font_config), angle
+    )
+    return (
+        sprite,
+        position["x_pos"] - (sprite.shape[1] - size[0]) // 2,
+        position["y_pos"] - (sprite.shape[0] - size[1]) // 2,
+    )
+
+
+def place_line(positions, frame_size, font_config):
+    # Frame position of a line's background box, which also clips its words
+    frame_width, frame_height = frame_size
+    max_width = max(p["x_pos"] + p["width"] for p in positions)
+    max_height = max(p["y_pos"] + p["height"] for p in positions)
+
+    box_width = int(max_width * 1.1 * font_config["background"]["size_factor"])
+    box_height = int(max_height * 1.1 * font_config["background"]["size_factor"])
+    line_x = int((frame_width - box_width) / 2)
+    line_y = int(
+        frame_height - max_height - font_config["bottom_offset_factor"] * frame_height
+    )
+    return {
+        "x": line_x,
+        "y": line_y,
+        "width": box_width,
+        "height": box_height,
+        "bounds": (
+            max(line_x, 0),
+            max(line_y, 0),
+            min(line_x + box_width, frame_width),
+            min(line_y + box_height, frame_height),
+        ),
+    }
@@ -0,0 +1,220 @@
+import bisect
+
+import numpy as np
+
+from helper_glyph import render_word
+from helper_lines import expand_subtitles
+from helper_caption import (
+    get_caption_styles,
+    layout_caption,
+    get_highlight_sprite,
+    place_line,
+)
+
+# Captions are pre-rendered into positioned RGBA layers once per clip. Each
+# frame only blends the layers that are active at that time, so the per-frame
+# cost depends on what is visible instead of the number of words in the clip.
+#
+# OverlaySchedule holds the layers of the whole clip. StreamingSchedule builds
+# the layers of a line when it comes on screen and drops them once it is
+# gone, so memory depends on the captions visible at once instead of the
+# length of the clip.
+
+
+def make_layer(image, x, y, start, end, bounds):
+    # Clip an RGBA image placed at (x, y) to bounds (x0, y0, x1, y1) and
+    # precompute the premultiplied colour and inverse alpha used for blending
+    x, y = int(x), int(y)
+    height, width = image.shape[:2]
+    x0, y0 = max(x, bounds[0]), max(y, bounds[1])
+    x1, y1 = min(x + width, bounds[2]), min(y + height, bounds[3])
+    if x0 >= x1 or y0 >= y1 or end <= start:
+        return None
+
+    crop = image[y0 - y : y1 - y, x0 - x : x1 - x]
+    alpha = crop[:, :, 3:4].astype(np.float32) / 255
+    if not alpha.any():
+        return None
+    # The 0.5 makes the final uint8 cast round instead of truncate
+    premultiplied = crop[:, :, :3].astype(np.float32) * alpha + 0.5
+    return {
+        "x0": x0,
+        "y0": y0,
+        "x1": x1,
+        "y1": y1,
+        "start": start,
+        "end": end,
+        "premultiplied": premultiplied,
+        "inverse_alpha": 1 - alpha,
+    }
+
+
+def build_line_layers(line, frame_size, font_config):
+    styles = get_caption_styles(frame_size, font_config)
+    positions = layout_caption(line, frame_size, font_config)
+    if not positions:
+        return []
+
+    placement = place_line(positions, frame_size, font_config)
+    line_x, line_y = placement["x"], placement["y"]
+    bounds = placement["bounds"]
+
+    images = []
+    if font_config["background"]["opacity"] > 0:
+        r, g, b = font_config["background"]["color"]
+        background = np.empty(
+            (placement["height"], placement["width"], 4), dtype=np.uint8
+        )
+        background[:] = (r, g, b, int(255 * font_config["background"]["opacity"]))
+        images.append((background, line_x, line_y, line["start"], line["end"]))
+
+    for position in positions:
+        images.append(
+            (
+                render_word(position["word"], styles["normal"]),
+                line_x + position["x_pos"],
+                line_y + position["y_pos"],
+                position["normal_start"],
+                position["normal_start"] + position["normal_duration"],
+            )
+        )
+
+    for position in positions:
+        sprite, x, y = get_highlight_sprite(position, styles["highlighted"], font_config)
+        images.append(
+            (sprite, line_x + x, line_y + y, position["start"], position["end"])
+        )
+
+    layers = []
+    for image, x, y, start, end in images:
+        layer = make_layer(image, x, y, start, end, bounds)
+        if layer is not None:
+            layers.append(layer)
+    return layers
+
+
+def build_caption_layers(linelevel_subtitles, frame_size, font_config):
+    layers = []
+    for line in expand_subtitles(linelevel_subtitles):
+        layers.extend(build_line_layers(line, frame_size, font_config))
+    # Blend order follows the order layers were built in
+    for order, layer in enumerate(layers):
+        layer["order"] = order
+    return layers
+
+
+class OverlaySchedule:
+    # Sorted event list over layer start times. Frames are normally requested
+    # in increasing time, so active layers are tracked with a sweep and only
+    # rebuilt when time goes backwards.
+
+    def __init__(self, layers):
+        self.layers = sorted(layers, key=lambda layer: layer["start"])
+        self.starts = [layer["start"] for layer in self.layers]
+        self.scratch = np.empty(
+            max((layer["premultiplied"].size for layer in layers), default=0),
+            dtype=np.float32,
+        )
+        self.reset()
+
+    def reset(self):
+        self._next = 0
+        self._active = []
+        self._time = None
+
+    def active_at(self, t):
+        if self._time is not None and t < self._time:
+            self.reset()
+        self._time = t
+
+        end = bisect.bisect_right(self.starts, t)
+        changed = end > self._next
+        if changed:
+            self._active.extend(self.layers[self._next : end])
+            self._next = end
+
+        active = [layer for layer in self._active if layer["end"] > t]
+        if changed or len(active) != len(self._active):
+            active.sort(key=lambda layer: layer["order"])
+        self._active = active
+        return active
+
+
+class StreamingSchedule:
+    # Same interface as OverlaySchedule over subtitle lines instead of
+    # layers. Line layers are built when time reaches the start of the line,
+    # each layer is dropped once it has ended. scratch is a float32 buffer as
+    # large as the largest layer built so far, for blend_layers.
+
+    def __init__(self, linelevel_subtitles, frame_size, font_config):
+        self.frame_size = frame_size
+        self.font_config = font_config
+        # Blend order is the order of the lines in the subtitles
+        self.lines = sorted(
+            enumerate(expand_subtitles(linelevel_subtitles)),
+            key=lambda item: item[1]["start"],
+        )
+        self.starts = [line["start"] for _, line in self.lines]
+        self.scratch = np.empty(0, dtype=np.float32)
+        self.peak_bytes = 0
+        self.reset()
+
+    def reset(self):
+        self._next = 0
+        self._live = {}
+        self._time = None
+
+    def build(self, index, line):
+        layers = build_line_layers(line, self.frame_size, self.font_config)
+        for order, layer in enumerate(layers):
+            layer["order"] = (index, order)
+            size = layer["premultiplied"].size
+            if size > self.scratch.size:
+                self.scratch = np.empty(size, dtype=np.float32)
+        return layers
+
+    def live_bytes(self):
+        return sum(
+            layer["premultiplied"].nbytes + layer["inverse_alpha"].nbytes
+            for layers in self._live.values()
+            for layer in layers
+        )
+
+    def active_at(self, t):
+        if self._time is not None and t < self._time:
+            self.reset()
+        self._time = t
+
+        end = bisect.bisect_right(self.starts, t)
+        if end > self._next:
+            for index, line in self.lines[self._next : end]:
+                self._live[index] = self.build(index, line)
+            self._next = end
+            self.peak_bytes = max(self.peak_bytes, self.live_bytes())
+
+        active = []
+        for index in list(self._live):
+            layers = [layer for layer in self._live[index] if layer["end"] > t]
+            if layers:
+                self._live[index] = layers
+                active.extend(layer for layer in layers if layer["start"] <= t)
+            else:
+                del self._live[index]
+        active.sort(key=lambda layer: layer["order"])
+        return active
+
+
+def blend_layers(frame, layers, scratch=None):
+    # Alpha blend the layers into the uint8 RGB frame in place. scratch, a
+    # float32 array at least as large as every layer, holds the intermediate
+    # result instead of a new array per layer and frame.
+    for layer in layers:
+        region = frame[layer["y0"] : layer["y1"], layer["x0"] : layer["x1"]]
+        if scratch is None:
+            blended = region * layer["inverse_alpha"]
+        else:
+            blended = scratch[: region.size].reshape(region.shape)
+            np.multiply(region, layer["inverse_alpha"], out=blended)
+        blended += layer["premultiplied"]
+        np.copyto(region, blended, casting="unsafe")
+    return frame
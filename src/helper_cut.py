@@ -0,0 +1,240 @@
+import os
+import shutil
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import ffmpeg
+
+import helper_metrics as metrics
+
+# Clip cutting with input side seeking (-ss before -i), so ffmpeg jumps to
+# the nearest keyframe instead of decoding from the start of the file.
+#
+# cut_mode "copy"     stream copies, the clip starts on the keyframe at or
+#                     before start_time
+# cut_mode "accurate" re-encodes the whole clip, frame accurate
+# cut_mode "smart"    re-encodes only the partial GOP up to the first keyframe
+#                     after start_time and stream copies the rest, frame
+#                     accurate at close to copy speed (H.264 sources only)
+
+CUT_MODES = ("copy", "accurate", "smart")
+SMART_CUT_CODECS = ("h264",)
+
+
+def _run(command):
+    metrics.count("ffmpeg_processes")
+    subprocess.run(command + ["-loglevel", "error"], check=True)
+
+
+def _inputs(source, start_time, audio_source=None):
+    # Seek every input, a separate audio input is mapped next to the video
+    inputs = ["-ss", str(start_time), "-i", source]
+    if audio_source is None:
+        return inputs
+    return inputs + [
+        "-ss", str(start_time),
+        "-i", audio_source,
+        "-map", "0:v:0",
+        "-map", "1:a:0",
+    ]
+
+
+def cut_copy(source, output_file, start_time, end_time, audio_source=None):
+    _run(
+        [
+            "ffmpeg", "-y",
+            *_inputs(source, start_time, audio_source),
+            "-t", str(end_time - start_time),
+            "-c", "copy",
+            "-avoid_negative_ts", "make_zero",
+            output_file,
+        ]
+    )
+
+
+def cut_accurate(source, output_file, start_time, end_time, audio_source=None):
+    _run(
+        [
+            "ffmpeg", "-y",
+            *_inputs(source, start_time, audio_source),
+            "-t", str(end_time - start_time),
+            "-c:v", "libx264", "-preset", "veryfast", "-crf", "18",
+            "-c:a", "aac",
+            output_file,
+        ]
+    )
+
+
+def find_keyframes(source, start_time, end_time):
+    # Keyframe times in [start_time, end_time], only that interval is read
+    command = [
+        "ffprobe", "-v", "error",
+        "-select_streams", "v:0",
+        "-skip_frame", "nokey",
+        "-show_entries", "frame=pts_time,best_effort_timestamp_time",
+        "-of", "csv=p=0",
+        "-read_intervals", f"{start_time}%{end_time}",
+        source,
+    ]
+    metrics.count("ffmpeg_processes")
+    result = subprocess.run(command, stdout=subprocess.PIPE, check=True, text=True)
+    keyframes = []
+    for line in result.stdout.splitlines():
+        for value in line.split(","):
+            try:
+                keyframes.append(float(value))
+                break
+            except ValueError:
+                continue
+    return sorted(t for t in keyframes if start_time <= t <= end_time)
+
+
+def cut_smart(source, output_file, start_time, end_time, video_stream, audio_source=None):
+    video_codec, frame_rate, has_audio = video_stream
+    if video_codec not in SMART_CUT_CODECS or not frame_rate:
+        return cut_accurate(source, output_file, start_time, end_time, audio_source)
+
+    keyframes = [t for t in find_keyframes(source, start_time, end_time) if t > start_time]
+    if not keyframes or keyframes[0] >= end_time:
+        # The clip fits inside one GOP, there is nothing to copy
+        return cut_accurate(source, output_file, start_time, end_time, audio_source)
+    keyframe = keyframes[0]
+
+    work_directory = tempfile.mkdtemp(dir=os.path.dirname(output_file) or None)
+    try:
+        head = os.path.join(work_directory, "head.h264")
+        tail = os.path.join(work_directory, "tail.h264")
+        audio = os.path.join(work_directory, "audio.m4a")
+        # Re-encode the partial GOP between the cut and the next keyframe
+        _run(
+            [
+                "ffmpeg", "-y",
+                "-ss", str(start_time),
+                "-i", source,
+                "-t", str(keyframe - start_time),
+                "-an",
+                "-c:v", "libx264", "-preset", "veryfast", "-crf", "18",
+                "-pix_fmt", "yuv420p",
+                "-f", "h264",
+                head,
+            ]
+        )
+        # Stream copy from the keyframe on. Annex B streams carry their
+        # parameter sets in band, so the two halves can simply be appended
+        # even though they were written by different encoders.
+        _run(
+            [
+                "ffmpeg", "-y",
+                "-ss", str(keyframe),
+                "-i", source,
+                "-t", str(end_time - keyframe),
+                "-an",
+                "-c:v", "copy",
+                "-bsf:v", "h264_mp4toannexb",
+                "-f", "h264",
+                tail,
+            ]
+        )
+        with open(head, "ab") as f, open(tail, "rb") as tail_file:
+            shutil.copyfileobj(tail_file, f)
+        audio_inputs, audio_maps = [], []
+        if audio_source or has_audio:
+            _run(
+                [
+                    "ffmpeg", "-y",
+                    "-ss", str(start_time),
+                    "-i", audio_source or source,
+                    "-t", str(end_time - start_time),
+                    "-vn",
+                    "-c:a", "aac",
+                    audio,
+                ]
+            )
+            audio_inputs, audio_maps = ["-i", audio], ["-map", "1:a:0"]
+        # The elementary stream has no timestamps, they are rebuilt from the
+        # source frame rate
+        _run(
+            [
+                "ffmpeg", "-y",
+                "-framerate", frame_rate,
+                "-i", head,
+            ]
+            + audio_inputs
+            + ["-map", "0:v:0"]
+            + audio_maps
+            + [
+                "-c", "copy",
+                "-movflags", "+faststart",
+                output_file,
+            ]
+        )
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+
+def get_frame_rate(video):
+    # ffprobe reports a rate it does not know as "0/0"
+    for key in ("avg_frame_rate", "r_frame_rate"):
+        rate = video.get(key)
+        if rate and not rate.startswith("0/") and not rate.endswith("/0"):
+            return rate
+    return None
+
+
+def get_video_stream(source):
+    # (codec name, frame rate) of the first video stream and whether the
+    # source has audio
+    metrics.count("ffmpeg_processes")
+    probe = ffmpeg.probe(source)
+    video = next((s for s in probe["streams"] if s["codec_type"] == "video"), None)
+    has_audio = any(s["codec_type"] == "audio" for s in probe["streams"])
+    if video is None:
+        return None, None, has_audio
+    return video["codec_name"], get_frame_rate(video), has_audio
+
+
+def cut_clip(
+    source, output_file, start_time, end_time, cut_mode="copy", video_stream=None, audio_source=None
+):
+    if cut_mode == "accurate":
+        cut_accurate(source, output_file, start_time, end_time, audio_source)
+    elif cut_mode == "smart":
+        cut_smart(source, output_file, start_time, end_time, video_stream, audio_source)
+    else:
+        cut_copy(source, output_file, start_time, end_time, audio_source)
+    return output_file
+
+
+@metrics.timed("cut_clips")
+def cut_clips(source, cuts, workers=4, cut_mode="copy", audio_source=None):
+    # cuts is a list of (output_file, start_time, end_time). source may be a
+    # local file or a seekable HTTP URL, audio_source a separate audio-only
+    # input. Cuts run in a bounded pool of ffmpeg processes, returns the
+    # output files that failed.
+    if cut_mode not in CUT_MODES:
+        raise ValueError(f"Unknown cut_mode: {cut_mode}")
+    video_stream = get_video_stream(source) if cut_mode == "smart" else None
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {
+            executor.submit(
+                metrics.bind(cut_clip),
+                source,
+                output_file,
+                start_time,
+                end_time,
+                cut_mode,
+                video_stream,
+                audio_source,
+            ): output_file
+            for output_file, start_time, end_time in cuts
+        }
+        for future in as_completed(futures):
+            try:
+                print(f"Cut clip: {future.result()}")
+            except Exception as e:
+                print(f"Failed to cut {futures[future]}: {e}")
+                failed.append(futures[future])
+    return failed
@@ -1,27 +1,52 @@
 import uuid
-from youtube_transcript_api import YouTubeTranscriptApi
-from pytube import YouTube
 import re
 
 import os
 import shutil
-import subprocess
 import json
+import subprocess
 
 from dotenv import load_dotenv
 
-load_dotenv()
-
-
-import google.generativeai as genai
-from openai import OpenAI
-
+import helper_metrics as metrics
+from helper_cache import (
+    DEFAULT_MAX_GB,
+    hash_key,
+    entry_path,
+    cached_json,
+    store_file,
+    restore_file,
+    update_manifest,
+    evict,
+)
+from helper_cut import cut_clips
+from helper_streams import get_target_height, stream_metadata, select_streams
+from helper_transcript import (
+    format_transcript,
+    count_tokens,
+    tokens_exact,
+    compact_transcript,
+    snap_clip_times,
+)
+from helper_llm import (
+    DEFAULT_WINDOW_SECONDS,
+    DEFAULT_OVERLAP_SECONDS,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_LLM_CACHE_MB,
+    complete,
+    get_completion,
+    check_llm_output,
+    get_retry_message,
+    validate_clips,
+    fit_clip_durations,
+    unique_titles,
+    get_transcript_end,
+    split_transcript,
+    merge_clips,
+    map_windows,
+)
 
-GOOGLE_API_KEY=os.environ["GOOGLE_API_KEY"]
-genai.configure(api_key=GOOGLE_API_KEY)
-
-OPENAI_KEY = os.environ["OPENAI_KEY"]
-client = OpenAI(api_key=OPENAI_KEY)
+load_dotenv()
 
 base_prompt = "Extract a list of all {topic_prompt} and the corresponding start and end timestamps where they are discussed in the following YouTube transcript. Ensure duration is within 20 to 80 seconds with recommended length of 30 sec,it is IMPORTANT video length should not be less than 20 sec and should be bound by limits. Format the output as a JSON array:"
 
@@ -63,7 +88,7 @@ def get_message(transcript, topic_prompt="Books", url_source=""):
   base_prompt_with_topic = base_prompt.format(topic_prompt=topic_prompt)
   additional_base_prompt_with_url_source_prompt = additional_base_prompt.format(url_source_prompt=url_source_prompt)
 
-  transcript_text = "\n".join([f"{item['start']} - {item['text']}" for item in transcript])
+  transcript_text = format_transcript(transcript)
   result = base_prompt_with_topic + output_format + additional_base_prompt_with_url_source_prompt + transcript_text
   return result
 
@@ -79,105 +104,337 @@ def get_video_id(url):
         raise ValueError("Invalid YouTube URL")
 
 def get_raw_transcript(url):
+    from youtube_transcript_api import YouTubeTranscriptApi
+
     video_id = get_video_id(url)
     transcript_list = YouTubeTranscriptApi.get_transcript(video_id)
     return transcript_list
 
-def get_llm_output(messageText, service = "gemini", model = ""):
-  if service == "gemini":
-      model = genai.GenerativeModel(model)
-      output = model.generate_content(messageText)
-      return output.text
-  elif service == "openai":
-      chat_completion = client.chat.completions.create(
-        messages=[
-          {
-            "role": "user",
-            "content": messageText,
-          }
-        ],
-        model=model,
-      )
-      return chat_completion.choices[0].message.content
-  else:
-    return "[]"
-
-
-def download_and_trim(url, base_directory, content_list):
-    try:
-        # If the directory already exists, remove it first
-        if os.path.exists(base_directory):
-            shutil.rmtree(base_directory)
-
-        yt = YouTube(url)
-        video = yt.streams.first().download(output_path=base_directory)
-        print(f"Downloaded video: {video}")
-
-        # Ensure the clips directory exists
-        clips_directory = os.path.join(base_directory, "clips")
-        os.makedirs(clips_directory, exist_ok=True)
-
-        for content in content_list:
-            start_time = content["start_time"]
-            end_time = content["end_time"]
-            title = content["title"]
-            output_file = os.path.join(clips_directory, f"{title}.mp4")
-
-            # Construct the ffmpeg command
-            ffmpeg_command = [
-                "ffmpeg",
-                "-i", video,
-                "-ss", str(start_time),
-                "-to", str(end_time),
-                "-c", "copy",
-                output_file,
-                "-loglevel", "error"
-            ]
-            # Run the ffmpeg command
-            subprocess.run(ffmpeg_command, check=True)
-
-    except Exception as e:
-        print(f"An error occurred: {e}")
+def get_llm_output(messageText, service = "gemini", model = "", base_url = None):
+  return complete(messageText, service, model, base_url)
 
 
-def get_clips(config):
-  name = config.get("name", uuid.uuid4().hex)
+def use_chunks(config, transcript):
+  llm_mode = config.get("llm_mode", "single")
+  if llm_mode == "auto":
+    window_seconds = config.get("llm_window_seconds", DEFAULT_WINDOW_SECONDS)
+    return get_transcript_end(transcript) > window_seconds
+  return llm_mode == "chunked"
+
+
+def request_clips(message, config, video_length=None):
+  # One prompt, then targeted retries while the reply or some of its clips
+  # fail validation. Every reply is cached, so a rerun costs no LLM calls.
+  # Returns (valid clips, raw replies).
+  service = config.get("service", "gemini")
+  model = config.get("model", "gemini-pro")
+  base_url = config.get("llm_base_url")
+
+  ttl_hours = config.get("llm_cache_ttl_hours")
+  max_age = ttl_hours * 3600 if ttl_hours else None
+
+  def ask(prompt):
+    return get_completion(prompt, service, model, base_url, max_age)
+
+  llm_outputs = [ask(message)]
+  clips, invalid, error = check_llm_output(llm_outputs[0], video_length)
+  for _ in range(config.get("llm_retries", 1)):
+    if error is None and not invalid:
+      break
+    print(f"Retrying the LLM: {error or f'{len(invalid)} invalid clips'}")
+    llm_outputs.append(ask(get_retry_message(message, invalid, error)))
+    if error is not None:
+      clips, invalid, error = check_llm_output(llm_outputs[-1], video_length)
+    else:
+      fixed, invalid, error = check_llm_output(llm_outputs[-1], video_length, kept = clips)
+      clips = clips + fixed
+      if error is not None:
+        # The old clips are still good, give up on the invalid ones only
+        break
+
+  if error is not None:
+    print(f"Unusable LLM output: {error}")
+  for clip, reason in invalid:
+    print(f"Dropping invalid clip {clip}: {reason}")
+  return clips, llm_outputs
+
+
+def extract_clips_chunked(transcript, config, video_length=None):
+  # Map: one prompt per overlapping transcript window, sent concurrently.
+  # Reduce: merge the clips of all windows and drop the overlap duplicates.
+  topic_prompt = config.get("topic_prompt", "Books")
+  url_source = config.get("url_source", "")
+
+  windows = split_transcript(
+      transcript,
+      config.get("llm_window_seconds", DEFAULT_WINDOW_SECONDS),
+      config.get("llm_window_overlap", DEFAULT_OVERLAP_SECONDS),
+  )
+  messages = [get_message(window, topic_prompt, url_source) for window in windows]
+  print(f"Extracting clips from {len(messages)} transcript windows")
+
+  outputs = map_windows(
+      messages,
+      lambda message: request_clips(message, config, video_length),
+      config.get("llm_concurrency", DEFAULT_CONCURRENCY),
+  )
+  result = merge_clips([clips for clips, _ in outputs])
+  return messages, [llm_outputs for _, llm_outputs in outputs], result
+
+
+def get_download_key(url, config):
+    return hash_key("download", url, get_target_height(config))
+
+
+def get_clip_key(download_key, content, download_mode="full", cut_mode="copy"):
+    return hash_key(
+        "clip",
+        download_key,
+        content["start_time"],
+        content["end_time"],
+        download_mode,
+        cut_mode,
+    )
+
+
+def find_cached_source(download_key):
+    directory = entry_path("downloads", download_key)
+    if os.path.isdir(directory):
+        for file in os.listdir(directory):
+            path = os.path.join(directory, file)
+            os.utime(path)
+            return path
+    return None
+
+
+def get_youtube(url):
+    # pytube is only imported once something has to be downloaded
+    from pytube import YouTube
+
+    return YouTube(url)
+
+
+def get_source_streams(yt, target_height):
+    # pytube streams for the selected video and audio (None if progressive)
+    selection = select_streams(
+        [stream_metadata(stream) for stream in yt.streams], target_height
+    )
+    video = yt.streams.get_by_itag(selection["video"]["itag"])
+    audio = selection["audio"] and yt.streams.get_by_itag(selection["audio"]["itag"])
+    print(f"Selected video stream: {selection['video']['height']}p {video.mime_type}")
+    if audio is not None:
+        print(f"Selected audio stream: {selection['audio']['abr']}kbps {audio.mime_type}")
+    return video, audio
+
+
+@metrics.timed("download_source")
+def download_source(url, download_key, target_height=1080):
+    # The full source video is kept in the cache, keyed by its URL and the
+    # output height the streams were selected for
+    video = find_cached_source(download_key)
+    if video is not None:
+        print(f"Using cached video: {video}")
+        return video
+
+    directory = entry_path("downloads", download_key)
+    tmp_directory = f"{directory}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_directory):
+        shutil.rmtree(tmp_directory)
+    video_stream, audio_stream = get_source_streams(get_youtube(url), target_height)
+    video = video_stream.download(output_path=tmp_directory, filename_prefix="video_")
+    metrics.count("bytes_downloaded", os.path.getsize(video))
+    if audio_stream is not None:
+        audio = audio_stream.download(output_path=tmp_directory, filename_prefix="audio_")
+        metrics.count("bytes_downloaded", os.path.getsize(audio))
+        # Adaptive streams come without sound, mux them without re-encoding
+        muxed = os.path.join(tmp_directory, "source.mp4")
+        ffmpeg_command = [
+            "ffmpeg",
+            "-i", video,
+            "-i", audio,
+            "-map", "0:v:0",
+            "-map", "1:a:0",
+            "-c", "copy",
+            muxed,
+            "-loglevel", "error"
+        ]
+        metrics.count("ffmpeg_processes")
+        subprocess.run(ffmpeg_command, check=True)
+        os.remove(video)
+        os.remove(audio)
+        video = muxed
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.replace(tmp_directory, directory)
+    video = os.path.join(directory, os.path.basename(video))
+    print(f"Downloaded video: {video}")
+    return video
+
+
+def resolve_stream_urls(url, target_height=1080):
+    # (video url, audio url or None) of the selected streams
+    video_stream, audio_stream = get_source_streams(get_youtube(url), target_height)
+    return video_stream.url, audio_stream.url if audio_stream is not None else None
+
+
+@metrics.timed("download_and_trim")
+def download_and_trim(url, base_directory, content_list, download_key=None, config=None):
+    config = config or {}
+    download_mode = config.get("download_mode", "full")
+    cut_mode = config.get("cut_mode", "copy")
+    # Clips of an earlier run are removed, unchanged ones come back from the cache
+    clips_directory = os.path.join(base_directory, "clips")
+    if os.path.exists(clips_directory):
+        shutil.rmtree(clips_directory)
+    os.makedirs(clips_directory, exist_ok=True)
+
+    target_height = get_target_height(config)
+    download_key = download_key or get_download_key(url, config)
+    video = find_cached_source(download_key)
+
+    missing = []
+    for content in content_list:
+        output_file = os.path.join(clips_directory, f"{content['title']}.mp4")
+        clip_key = get_clip_key(download_key, content, download_mode, cut_mode)
+        if not restore_file("clips", clip_key, output_file, ".mp4"):
+            missing.append(content)
+
+    if missing:
+        segments = download_mode == "segments" and video is None
+        if segments:
+            # Seeking on the input makes ffmpeg issue HTTP range requests,
+            # so only the bytes around each clip are downloaded
+            source, audio_source = resolve_stream_urls(url, target_height)
+            workers = config.get("download_workers", 4)
+        else:
+            source = video or download_source(url, download_key, target_height)
+            audio_source = None
+            video = source
+            workers = config.get("cut_workers", 4)
+        failed = cut_clips(
+            source,
+            [
+                (
+                    os.path.join(clips_directory, f"{content['title']}.mp4"),
+                    content["start_time"],
+                    content["end_time"],
+                )
+                for content in missing
+            ],
+            workers = workers,
+            cut_mode = cut_mode,
+            audio_source = audio_source,
+        )
+        for output_file in failed:
+            metrics.event("clip_failed", stage="cut", clip=os.path.basename(output_file))
+        missing = [
+            content
+            for content in missing
+            if os.path.join(clips_directory, f"{content['title']}.mp4") not in failed
+        ]
+        if segments:
+            # Segments are fetched straight into the clips, their size is what
+            # was downloaded (the range reads around them are not counted)
+            for content in missing:
+                metrics.count(
+                    "bytes_downloaded",
+                    os.path.getsize(os.path.join(clips_directory, f"{content['title']}.mp4")),
+                    mode="segments",
+                )
+
+    for content in missing:
+        store_file(
+            "clips",
+            get_clip_key(download_key, content, download_mode, cut_mode),
+            os.path.join(clips_directory, f"{content['title']}.mp4"),
+            ".mp4",
+        )
+
+    return video
+
+
+@metrics.timed("plan")
+def plan_clips(config):
+  # Transcript and LLM stages, returns the llmOutput.json document
   url = config.get("url", "")
   topic_prompt = config.get("topic_prompt", "Books")
   service = config.get("service", "gemini")
   model = config.get("model", "gemini-pro")
   url_source = config.get("url_source", "")
+  base_url = config.get("llm_base_url")
+
+  # Every stage is cached by a hash of its inputs, so a rerun only
+  # recomputes what changed
+  transcript_key = hash_key("transcript", get_video_id(url))
+  transcript = cached_json("transcripts", transcript_key, lambda: get_raw_transcript(url))
+  prompt_transcript = transcript
+  if config.get("compact_transcript"):
+    prompt_transcript = compact_transcript(
+        transcript, drop_filler = config.get("drop_filler", False)
+    )
+    tokens_before = count_tokens(format_transcript(transcript))
+    tokens_after = count_tokens(format_transcript(prompt_transcript))
+    if tokens_exact():
+      print(f"Transcript tokens: {tokens_before} -> {tokens_after}")
+    else:
+      print(
+          f"Transcript tokens (estimated, tiktoken is not installed): "
+          f"~{tokens_before} -> ~{tokens_after}"
+      )
+  video_length = get_transcript_end(transcript)
+  if use_chunks(config, prompt_transcript):
+    message, llm_outputs, result = extract_clips_chunked(
+        prompt_transcript, config, video_length
+    )
+  else:
+    message = get_message(prompt_transcript, topic_prompt, url_source)
+    result, llm_outputs = request_clips(message, config, video_length)
+  llm_key = hash_key("llm-output", service, model, base_url, llm_outputs)
+  if prompt_transcript is not transcript:
+    # The model saw rounded span starts, cut on the original fragments.
+    # Snapping moves the ends by a second or so, bring those clips back
+    # into range instead of dropping them.
+    snap_clip_times(result, transcript)
+    fit_clip_durations(result, video_length)
+  # Clips of different windows can still overlap each other
+  result, invalid = validate_clips(result, video_length)
+  for clip, reason in invalid:
+    print(f"Dropping invalid clip {clip['title']}: {reason}")
+  unique_titles(result)
+  evict(config.get("llm_cache_max_mb", DEFAULT_LLM_CACHE_MB) / 1024, stage = "llm")
+  return {
+    "message": message,
+    "model": model,
+    "service": service,
+    "llmOutput": llm_outputs,
+    "clips": result,
+    "transcript_key": transcript_key,
+    "llm_key": llm_key
+  }
 
 
+@metrics.timed("download")
+def download_clips(config, output):
+  # Download stage for a plan from plan_clips, writes llmOutput.json
+  name = config.get("name", uuid.uuid4().hex)
+  url = config.get("url", "")
+
   pwd = os.getcwd()
   base_directory = os.path.join(pwd, "output", name)
   os.makedirs(base_directory, exist_ok=True)
   
   path_for_output = os.path.join(base_directory, "llmOutput.json")
-  if (os.path.exists(path_for_output)):
-    print("Output already exists, skipping...")
-    return
-  
 
-  transcript = get_raw_transcript(url)
-  message = get_message(transcript, topic_prompt, url_source)
-  llmOutput = get_llm_output(message ,service,model)
-  llmOutput = llmOutput.replace("```", "")
-  llmOutput = llmOutput.replace("json", "")
-  result = json.loads(llmOutput)
-  for item in result:
-     item["title"] = item["title"].replace(" ", "_").replace("/", "_")
-  output = {
-    "message": message,
-    "model": model,
-    "service": service,
-    "llmOutput": llmOutput,
-    "clips": result
-  }
-  download_and_trim(
+  result = output["clips"]
+  download_key = get_download_key(url, config)
+  download_mode = config.get("download_mode", "full")
+  cut_mode = config.get("cut_mode", "copy")
+  output["source_video"] = download_and_trim(
       url = url,
       base_directory = base_directory,
-      content_list = result
+      content_list = result,
+      download_key = download_key,
+      config = config
   )
   try:
       with open(path_for_output, "w") as f:
@@ -185,3 +442,20 @@ def get_clips(config):
       print(f"Output saved to: {path_for_output}")
   except Exception as e:
       print(f"An error occurred while saving the file: {e}")
+
+  update_manifest(
+      name,
+      transcript = output["transcript_key"],
+      llm = output["llm_key"],
+      download = download_key,
+      clips = {
+          f"{item['title']}.mp4": get_clip_key(download_key, item, download_mode, cut_mode)
+          for item in result
+      }
+  )
+  evict(config.get("cache_max_gb", DEFAULT_MAX_GB))
+  return output
+
+
+def get_clips(config):
+  return download_clips(config, plan_clips(config))
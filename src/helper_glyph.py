@@ -0,0 +1,207 @@
+import os
+import math
+import hashlib
+import threading
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+# Word bitmaps are rasterized in-process with Pillow/FreeType instead of
+# shelling out to ImageMagick for every TextClip. Each bitmap is cached in
+# memory for the lifetime of the process and on disk across runs.
+
+FONT_DIRS = [
+    "/usr/share/fonts",
+    "/usr/local/share/fonts",
+    os.path.expanduser("~/.fonts"),
+    os.path.expanduser("~/.local/share/fonts"),
+    "/Library/Fonts",
+    "/System/Library/Fonts",
+    "C:\\Windows\\Fonts",
+]
+FONT_EXTENSIONS = (".ttf", ".otf", ".ttc")
+
+GLYPH_CACHE_DIR = os.path.join(os.getcwd(), "output", ".glyph_cache")
+
+
+def _normalize_font_name(name):
+    return "".join(ch for ch in name.lower() if ch.isalnum())
+
+
+@lru_cache(maxsize=None)
+def _font_index():
+    index = {}
+    for font_dir in FONT_DIRS:
+        for root, _, files in os.walk(font_dir):
+            for file in sorted(files):
+                stem, ext = os.path.splitext(file)
+                if ext.lower() in FONT_EXTENSIONS:
+                    index.setdefault(
+                        _normalize_font_name(stem), os.path.join(root, file)
+                    )
+    return index
+
+
+@lru_cache(maxsize=None)
+def resolve_font_path(font):
+    # Accept either a font file path or an ImageMagick style name such as
+    # "Montserrat-ExtraBold", matched against installed font file names
+    if os.path.isfile(font):
+        return font
+    path = _font_index().get(_normalize_font_name(font))
+    if path is None:
+        raise ValueError(f"Font not found: {font}")
+    return path
+
+
+@lru_cache(maxsize=64)
+def get_font(font, size):
+    return ImageFont.truetype(resolve_font_path(font), size)
+
+
+def get_style(style_config, fontsize):
+    # A style is a hashable (font, size, color, stroke_color, stroke_width) tuple
+    return (
+        style_config["font"],
+        max(1, int(round(fontsize * style_config.get("font_size_factor", 1)))),
+        style_config.get("color", "white"),
+        style_config.get("stroke_color"),
+        style_config.get("stroke_width", 0),
+    )
+
+
+def _rasterize_word(text, style):
+    font_name, size, color, stroke_color, stroke_width = style
+    font = get_font(font_name, size)
+    stroke = int(math.ceil(stroke_width)) if stroke_color else 0
+
+    ascent, descent = font.getmetrics()
+    left, _, right, _ = font.getbbox(text, stroke_width=stroke)
+    offset_x = max(0, -left)
+    width = max(1, offset_x + max(right, int(math.ceil(font.getlength(text))) + stroke))
+    height = ascent + descent + 2 * stroke
+
+    image = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    draw.text(
+        (offset_x, stroke),
+        text,
+        font=font,
+        fill=color,
+        stroke_width=stroke,
+        stroke_fill=stroke_color,
+    )
+    return np.array(image)
+
+
+def _disk_cache_path(text, style):
+    key = repr((text, style, resolve_font_path(style[0])))
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return os.path.join(GLYPH_CACHE_DIR, digest[:2], f"{digest}.npy")
+
+
+@lru_cache(maxsize=4096)
+def render_word(text, style):
+    path = _disk_cache_path(text, style)
+    bitmap = None
+    if os.path.exists(path):
+        try:
+            bitmap = np.load(path)
+        except Exception as e:
+            print(f"Ignoring unreadable glyph cache entry {path}: {e}")
+    if bitmap is None:
+        bitmap = _rasterize_word(text, style)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Split renders build the same words on one thread per variant, every
+        # writer needs its own temporary file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, bitmap)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # The bitmap in memory is good either way, the cache entry is
+            # there unless another writer failed as well
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if not os.path.exists(path):
+                print(f"Could not write glyph cache entry {path}: {e}")
+    # Bitmaps are shared between lines and clips, never modify them in place
+    bitmap.flags.writeable = False
+    return bitmap
+
+
+def measure_word(text, style):
+    bitmap = render_word(text, style)
+    return bitmap.shape[1], bitmap.shape[0]
+
+
+def create_rounded_image(size, radius, color, opacity):
+    width, height = size
+    # Parse the color and apply the opacity
+    r, g, b = color
+    color_with_opacity = (r, g, b, int(255 * opacity))  # Opacity is scaled to 0-255
+
+    # Create an RGBA image to accommodate opacity
+    image = Image.new("RGBA", (width, height), (0, 0, 0, 0))  # Transparent background
+    draw = ImageDraw.Draw(image)
+    draw.rounded_rectangle(
+        [0, 0, width, height], radius=radius, fill=color_with_opacity
+    )
+    return image
+
+
+def paste_over(background, overlay, position):
+    # Alpha composite a PIL RGBA overlay onto background in place, clipping
+    # anything that falls outside of it
+    x, y = int(position[0]), int(position[1])
+    source = (max(0, -x), max(0, -y))
+    if source[0] >= overlay.width or source[1] >= overlay.height:
+        return background
+    background.alpha_composite(overlay, dest=(max(0, x), max(0, y)), source=source)
+    return background
+
+
+@lru_cache(maxsize=1024)
+def render_highlight(text, size, style, background):
+    # background is a hashable (color, opacity, radius) tuple
+    color, opacity, radius = background
+    image = create_rounded_image(size, radius, color, opacity)
+    word = Image.fromarray(render_word(text, style))
+    paste_over(
+        image,
+        word,
+        ((image.width - word.width) // 2, (image.height - word.height) // 2),
+    )
+    bitmap = np.array(image)
+    bitmap.flags.writeable = False
+    return bitmap
+
+
+# Highlight angles are quantized so the rotated sprites of a word repeat and
+# can be cached like the unrotated ones
+ROTATION_STEP = 0.5
+
+
+def highlight_angle(text, start, max_degree, step=ROTATION_STEP):
+    # Seeded by the word and its start time instead of a random draw, so a
+    # render always comes out the same
+    if not max_degree:
+        return 0.0
+    digest = hashlib.sha1(f"{text}\0{round(start, 3)}".encode("utf-8")).digest()
+    fraction = int.from_bytes(digest[:8], "big") / 2**64
+    angle = round((fraction * 2 - 1) * max_degree / step) * step
+    return float(max(-max_degree, min(max_degree, angle)))
+
+
+@lru_cache(maxsize=1024)
+def render_rotated_highlight(text, size, style, background, angle):
+    bitmap = render_highlight(text, size, style, background)
+    if not angle:
+        return bitmap
+    bitmap = np.array(
+        Image.fromarray(bitmap).rotate(angle, resample=Image.BICUBIC, expand=True)
+    )
+    bitmap.flags.writeable = False
+    return bitmap
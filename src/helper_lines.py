@@ -0,0 +1,124 @@
+import numpy as np
+
+# Subtitle line splitting over columnar word arrays. Words are kept as
+# (start, end, char_len) columns and every limit is tracked with running
+# counters, so a transcript is split in one pass however long the lines are.
+#
+# Subtitles are stored compactly, the words once and every line as a
+# [first, end) range of word indices:
+#
+#   {"format": "compact", "words": [...], "starts": [...], "ends": [...],
+#    "lines": [[0, 4], [4, 9], ...]}
+#
+# expand_subtitles turns either this or the older list of line dicts into
+# the line dicts the renderers work with.
+
+COMPACT_FORMAT = "compact"
+
+
+def word_columns(wordlevel_info):
+    words = [word["word"] for word in wordlevel_info]
+    starts = np.array([word["start"] for word in wordlevel_info], dtype=np.float64)
+    ends = np.array([word["end"] for word in wordlevel_info], dtype=np.float64)
+    char_lens = np.array([len(word) for word in words], dtype=np.int64)
+    return words, starts, ends, char_lens
+
+
+def split_ranges(
+    starts,
+    ends,
+    char_lens,
+    max_chars=30,
+    max_duration=2.5,
+    max_gap=1.5,
+    widths=None,
+    max_width=None,
+    space_width=0,
+):
+    # Returns [first, end) word ranges. A line ends after the word that takes
+    # it over max_chars or max_duration, or that follows a pause longer than
+    # max_gap. With widths, a line also ends before a word that would make it
+    # wider than max_width pixels, so it always fits.
+    count = len(starts)
+    if not count:
+        return []
+    durations = (ends - starts).tolist()
+    gaps = np.concatenate(([-np.inf], starts[1:] - ends[:-1])).tolist()
+    char_lens = np.asarray(char_lens).tolist()
+    if widths is not None:
+        widths = np.asarray(widths).tolist()
+
+    ranges = []
+    first = 0
+    duration = 0.0
+    chars = -1
+    width = -space_width
+    for index in range(count):
+        if (
+            widths is not None
+            and index > first
+            and width + space_width + widths[index] > max_width
+        ):
+            ranges.append((first, index))
+            first, duration, chars, width = index, 0.0, -1, -space_width
+
+        # Joined with single spaces, so every word adds one separator
+        duration += durations[index]
+        chars += char_lens[index] + 1
+        if widths is not None:
+            width += space_width + widths[index]
+
+        if duration > max_duration or chars > max_chars or gaps[index] > max_gap:
+            ranges.append((first, index + 1))
+            first, duration, chars, width = index + 1, 0.0, -1, -space_width
+
+    if first < count:
+        ranges.append((first, count))
+    return ranges
+
+
+def split_words(wordlevel_info, subtitle_config, measure=None):
+    # measure, if given, is (widths, max_width, space_width) for pixel width
+    # splitting
+    words, starts, ends, char_lens = word_columns(wordlevel_info)
+    widths, max_width, space_width = measure or (None, None, 0)
+    ranges = split_ranges(
+        starts,
+        ends,
+        char_lens,
+        subtitle_config.get("max_chars", 30),
+        subtitle_config.get("max_duration", 2.5),
+        subtitle_config.get("max_gap", 1.5),
+        widths,
+        max_width,
+        space_width,
+    )
+    return {
+        "format": COMPACT_FORMAT,
+        "words": words,
+        "starts": starts.tolist(),
+        "ends": ends.tolist(),
+        "lines": [list(line) for line in ranges],
+    }
+
+
+def expand_subtitles(subtitles):
+    # Line dicts with "word", "start", "end" and "textcontents" from either
+    # subtitle format
+    if not isinstance(subtitles, dict) or subtitles.get("format") != COMPACT_FORMAT:
+        return subtitles
+    words, starts, ends = subtitles["words"], subtitles["starts"], subtitles["ends"]
+    lines = []
+    for first, end in subtitles["lines"]:
+        lines.append(
+            {
+                "word": " ".join(words[first:end]),
+                "start": starts[first],
+                "end": ends[end - 1],
+                "textcontents": [
+                    {"word": words[index], "start": starts[index], "end": ends[index]}
+                    for index in range(first, end)
+                ],
+            }
+        )
+    return lines
@@ -0,0 +1,499 @@
+import os
+import re
+import json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import helper_metrics as metrics
+from helper_cache import hash_key, cached_json
+from helper_transcript import count_tokens, tokens_exact
+
+# LLM clients and chunked clip extraction. Long transcripts are split into
+# overlapping time windows, every window is sent as its own prompt through one
+# shared client (the OpenAI client pools its HTTP connections and is safe to
+# use from threads), and the clips of all windows are merged, dropping the
+# copies of clips that were found again in the overlap.
+#
+# llm_base_url points either service at another endpoint, for example a local
+# mock server, and the "mock" service answers offline.
+
+DEFAULT_WINDOW_SECONDS = 600
+DEFAULT_OVERLAP_SECONDS = 60
+DEFAULT_CONCURRENCY = 4
+DEFAULT_LLM_CACHE_MB = 500
+# Clips overlapping by more than this share of the shorter one are duplicates
+DUPLICATE_OVERLAP = 0.5
+MIN_CLIP_SECONDS = 20
+MAX_CLIP_SECONDS = 80
+MAX_TITLE_LENGTH = 80
+
+_clients = {}
+_inflight = {}
+_lock = threading.Lock()
+
+
+def get_openai_client(base_url=None):
+    with _lock:
+        if ("openai", base_url) not in _clients:
+            from openai import OpenAI
+
+            _clients[("openai", base_url)] = OpenAI(
+                api_key=os.environ["OPENAI_KEY"], base_url=base_url
+            )
+    return _clients[("openai", base_url)]
+
+
+def get_gemini_model(model, base_url=None):
+    # genai.configure is process wide and a model only picks up its client
+    # on its first request, so a second endpoint would silently take over
+    # the requests of models created for the first one
+    with _lock:
+        if ("gemini", model, base_url) not in _clients:
+            import google.generativeai as genai
+
+            endpoints = {key[2] for key in _clients if key[0] == "gemini"}
+            if endpoints and endpoints != {base_url}:
+                raise ValueError(
+                    f"Gemini llm_base_url {base_url!r} differs from {endpoints.pop()!r} "
+                    "already used in this process, run them in separate processes"
+                )
+            if base_url:
+                genai.configure(
+                    api_key=os.environ["GOOGLE_API_KEY"],
+                    transport="rest",
+                    client_options={"api_endpoint": base_url},
+                )
+            else:
+                genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
+            _clients[("gemini", model, base_url)] = genai.GenerativeModel(model)
+    return _clients[("gemini", model, base_url)]
+
+
+def mock_complete(message):
+    # Offline stand-in for the LLM services: a 30 second clip for about every
+    # two minutes of the transcript in the prompt
+    starts = [
+        float(match.group(1))
+        for match in re.finditer(r"^(\d+(?:\.\d+)?) - ", message, re.MULTILINE)
+    ]
+    clips = []
+    next_start = None
+    for start in starts:
+        if next_start is None or start >= next_start:
+            clips.append(
+                {
+                    "title": f"Clip at {int(start)}s",
+                    "info": "",
+                    "why_clip_was_chosen": "mock",
+                    "url": "",
+                    "start_time": int(start),
+                    "end_time": int(start) + 30,
+                }
+            )
+            next_start = start + 120
+    return json.dumps(clips, indent=2)
+
+
+def complete(message, service="gemini", model="", base_url=None):
+    if service == "mock":
+        return mock_complete(message)
+    if service == "gemini":
+        output = get_gemini_model(model, base_url).generate_content(message)
+        return output.text
+    elif service == "openai":
+        chat_completion = get_openai_client(base_url).chat.completions.create(
+            messages=[
+                {
+                    "role": "user",
+                    "content": message,
+                }
+            ],
+            model=model,
+        )
+        return chat_completion.choices[0].message.content
+    else:
+        return "[]"
+
+
+def request_completion(message, service="gemini", model="", base_url=None):
+    # A request that actually reaches the model
+    with metrics.span("llm_request", service=service, model=model):
+        output = complete(message, service, model, base_url)
+    metrics.count("llm_requests")
+    if metrics.enabled():
+        exact = tokens_exact()
+        metrics.count("llm_prompt_tokens", count_tokens(message), exact=exact)
+        metrics.count("llm_output_tokens", count_tokens(output or ""), exact=exact)
+    return output
+
+
+def get_llm_key(service, model, message, base_url=None):
+    # Outputs of another endpoint, such as a mock server, are cached apart
+    if base_url:
+        return hash_key("llm", service, model, message, base_url)
+    return hash_key("llm", service, model, message)
+
+
+def coalesce(key, compute):
+    # Threads asking for the same key while it is being computed wait for
+    # that one result instead of computing it again
+    with _lock:
+        future = _inflight.get(key)
+        owner = future is None
+        if owner:
+            future = _inflight[key] = Future()
+    if not owner:
+        return future.result()
+    try:
+        future.set_result(compute())
+    except BaseException as e:
+        future.set_exception(e)
+    finally:
+        with _lock:
+            del _inflight[key]
+    return future.result()
+
+
+def get_completion(message, service="gemini", model="", base_url=None, max_age=None):
+    # Completion through the on-disk cache, identical concurrent prompts
+    # (windows of different jobs, pipeline jobs of the same video) share one
+    # request
+    llm_key = get_llm_key(service, model, message, base_url)
+    return coalesce(
+        llm_key,
+        lambda: cached_json(
+            "llm",
+            llm_key,
+            lambda: request_completion(message, service, model, base_url),
+            max_age,
+        ),
+    )
+
+
+def extract_json_array(text):
+    # The first balanced [...] in the reply, brackets inside strings ignored
+    start = text.find("[")
+    while start != -1:
+        depth = 0
+        in_string = None
+        escaped = False
+        for index in range(start, len(text)):
+            char = text[index]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == in_string:
+                    in_string = None
+            elif char in "\"'":
+                in_string = char
+            elif char == "[":
+                depth += 1
+            elif char == "]":
+                depth -= 1
+                if depth == 0:
+                    return text[start:index + 1]
+        start = text.find("[", start + 1)
+    raise ValueError("No JSON array in the LLM output")
+
+
+# Opening quote to closing quote of the string kinds models produce
+QUOTE_PAIRS = {'"': '"', "\u201c": "\u201d", "'": "'", "\u2018": "\u2019"}
+PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def _skip_spaces(text, index, comments=False):
+    while index < len(text):
+        if text[index].isspace():
+            index += 1
+        elif comments and text.startswith("//", index):
+            newline = text.find("\n", index)
+            index = len(text) if newline == -1 else newline
+        else:
+            break
+    return index
+
+
+def _read_string(text, index, close):
+    # (JSON string literal, index after the closing quote) for a string
+    # opened at index. Other quote styles are rewritten as double quoted.
+    if close == '"' and text[index] == '"':
+        end = index + 1
+        while end < len(text) and text[end] != '"':
+            end += 2 if text[end] == "\\" else 1
+        return text[index : end + 1], end + 1
+    chars = ['"']
+    end = index + 1
+    while end < len(text) and text[end] != close:
+        if text[end] == "\\" and end + 1 < len(text):
+            # \' is only an escape in the original quoting
+            chars.append("'" if text[end + 1] == "'" else text[end : end + 2])
+            end += 2
+            continue
+        chars.append('\\"' if text[end] == '"' else text[end])
+        end += 1
+    chars.append('"')
+    return "".join(chars), end + 1
+
+
+def repair_json(text, only_commas=False):
+    # Fixes the defects models commonly produce: trailing commas and, unless
+    # only_commas, smart quotes, // comments, single quoted strings, unquoted
+    # keys and Python literals. The text is rewritten token by token, so the
+    # inside of a string value is never touched.
+    out = []
+    index = 0
+    last = ""
+    while index < len(text):
+        char = text[index]
+        if char == '"' or (not only_commas and char in QUOTE_PAIRS):
+            literal, index = _read_string(text, index, QUOTE_PAIRS[char])
+            out.append(literal)
+            last = '"'
+            continue
+        if not only_commas and text.startswith("//", index):
+            newline = text.find("\n", index)
+            index = len(text) if newline == -1 else newline
+            continue
+        if char == ",":
+            following = _skip_spaces(text, index + 1, comments=not only_commas)
+            if following < len(text) and text[following] in "}]":
+                index += 1
+                continue
+        if not only_commas and (char.isalpha() or char == "_"):
+            end = index
+            while end < len(text) and (text[end].isalnum() or text[end] == "_"):
+                end += 1
+            word = text[index:end]
+            following = _skip_spaces(text, end)
+            if last in ("{", ",") and following < len(text) and text[following] == ":":
+                out.append(json.dumps(word))
+            else:
+                out.append(PYTHON_LITERALS.get(word, word))
+            last = word[-1]
+            index = end
+            continue
+        out.append(char)
+        if not char.isspace():
+            last = char
+        index += 1
+    return "".join(out)
+
+
+def parse_clip_list(llm_output):
+    array = extract_json_array(llm_output)
+    try:
+        result = json.loads(array)
+    except ValueError:
+        try:
+            # Most replies only have a trailing comma too many
+            result = json.loads(repair_json(array, only_commas=True))
+        except ValueError:
+            result = json.loads(repair_json(array))
+    if not isinstance(result, list):
+        raise ValueError("LLM output is not a JSON array")
+    return result
+
+
+def to_seconds(value):
+    # Seconds as a number, a numeric string or a [hh:]mm:ss string
+    if isinstance(value, bool):
+        raise ValueError(f"Invalid time {value!r}")
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = str(value).strip()
+    if ":" in value:
+        seconds = 0.0
+        for part in value.split(":"):
+            seconds = seconds * 60 + float(part)
+        return seconds
+    return float(value)
+
+
+def safe_title(title):
+    title = re.sub(r"[^\w\-]+", "_", str(title or "")).strip("_")
+    return re.sub(r"_+", "_", title)[:MAX_TITLE_LENGTH].rstrip("_") or "clip"
+
+
+def unique_titles(clips):
+    # Clip files are named after titles, make them unique even on case
+    # insensitive file systems
+    seen = set()
+    for clip in clips:
+        title = base = clip["title"]
+        number = 2
+        while title.lower() in seen:
+            title = f"{base}_{number}"
+            number += 1
+        seen.add(title.lower())
+        clip["title"] = title
+    return clips
+
+
+def validate_clip(clip, video_length=None, slack=0):
+    # Returns the normalised clip, raises ValueError with the reason
+    if not isinstance(clip, dict):
+        raise ValueError("not an object")
+    for key in ("title", "start_time", "end_time"):
+        if clip.get(key) in (None, ""):
+            raise ValueError(f"missing {key}")
+    clip = dict(clip)
+    clip["title"] = safe_title(clip["title"])
+    start_time = max(to_seconds(clip["start_time"]), 0.0)
+    end_time = to_seconds(clip["end_time"])
+    if video_length:
+        start_time = min(start_time, float(video_length))
+        end_time = min(end_time, float(video_length))
+    duration = end_time - start_time
+    if not MIN_CLIP_SECONDS - slack <= duration <= MAX_CLIP_SECONDS + slack:
+        raise ValueError(
+            f"duration {duration:g}s is outside {MIN_CLIP_SECONDS}-{MAX_CLIP_SECONDS}s"
+        )
+    clip["start_time"] = int(start_time) if start_time.is_integer() else start_time
+    clip["end_time"] = int(end_time) if end_time.is_integer() else end_time
+    for key in ("info", "why_clip_was_chosen", "url"):
+        if clip.get(key) is None:
+            clip[key] = ""
+        elif not isinstance(clip[key], str):
+            clip[key] = str(clip[key])
+    return clip
+
+
+def fit_clip_durations(clips, video_length=None):
+    # Moves the ends of clips whose duration drifted out of range, e.g. after
+    # snapping onto fragments, back to MIN_CLIP_SECONDS-MAX_CLIP_SECONDS
+    for clip in clips:
+        try:
+            start_time = max(to_seconds(clip["start_time"]), 0.0)
+            end_time = to_seconds(clip["end_time"])
+        except (KeyError, TypeError, ValueError):
+            # validate_clips reports it
+            continue
+        end_time = min(max(end_time, start_time + MIN_CLIP_SECONDS), start_time + MAX_CLIP_SECONDS)
+        if video_length and end_time > float(video_length):
+            end_time = float(video_length)
+            start_time = max(min(start_time, end_time - MIN_CLIP_SECONDS), 0)
+        clip["start_time"] = round(start_time, 2)
+        clip["end_time"] = round(end_time, 2)
+    return clips
+
+
+def validate_clips(clips, video_length=None, slack=0, kept=()):
+    # Returns (valid clips, [(clip, reason)] of the invalid ones). Valid clips
+    # never overlap each other or the already kept ones, the earlier clip wins.
+    checked = []
+    invalid = []
+    for clip in clips:
+        try:
+            checked.append(validate_clip(clip, video_length, slack))
+        except (ValueError, TypeError) as e:
+            invalid.append((clip, str(e)))
+
+    valid = list(kept)
+    for clip in sorted(checked, key=lambda clip: (clip["start_time"], clip["end_time"])):
+        overlapping = next(
+            (
+                other
+                for other in valid
+                if clip["start_time"] < other["end_time"]
+                and other["start_time"] < clip["end_time"]
+            ),
+            None,
+        )
+        if overlapping is not None:
+            # Not worth a retry, the other clip already covers this stretch
+            print(f"Dropping clip {clip['title']}, it overlaps {overlapping['title']}")
+            continue
+        valid.append(clip)
+    return valid[len(kept):], invalid
+
+
+def check_llm_output(llm_output, video_length=None, kept=()):
+    # Returns (valid clips, invalid clips with reasons, error). error is set
+    # when the reply as a whole is unusable.
+    try:
+        clips = parse_clip_list(llm_output)
+    except ValueError as e:
+        return [], [], str(e)
+    valid, invalid = validate_clips(clips, video_length, kept=kept)
+    return valid, invalid, None
+
+
+def get_retry_message(message, invalid, error=None):
+    # Asks again for the whole answer when it was unusable, otherwise only
+    # for the clips that failed validation
+    if error is not None:
+        return (
+            f"{message}\n\nYour previous answer could not be used ({error}). "
+            "Answer again with only the JSON array."
+        )
+    lines = [f"- {json.dumps(clip, default=str)}: {reason}" for clip, reason in invalid]
+    return (
+        f"{message}\n\nThese clips from your previous answer are invalid:\n"
+        + "\n".join(lines)
+        + "\n\nReturn a JSON array with corrected versions of only these clips, "
+        f"each {MIN_CLIP_SECONDS} to {MAX_CLIP_SECONDS} seconds long. Return [] if "
+        "they cannot be fixed."
+    )
+
+
+def get_transcript_end(transcript):
+    if not transcript:
+        return 0
+    return max(item["start"] + item.get("duration", 0) for item in transcript)
+
+
+def split_transcript(transcript, window_seconds=DEFAULT_WINDOW_SECONDS, overlap_seconds=DEFAULT_OVERLAP_SECONDS):
+    # Overlapping windows of transcript entries, by entry start time. A clip
+    # that straddles a window boundary is still whole in one of the windows as
+    # long as it is shorter than the overlap.
+    step = max(window_seconds - overlap_seconds, 1)
+    end = get_transcript_end(transcript)
+    windows = []
+    window_start = 0
+    while True:
+        window = [
+            item
+            for item in transcript
+            if window_start <= item["start"] < window_start + window_seconds
+        ]
+        if window:
+            windows.append(window)
+        if window_start + window_seconds >= end:
+            break
+        window_start += step
+    return windows
+
+
+def clip_overlap(a, b):
+    overlap = min(a["end_time"], b["end_time"]) - max(a["start_time"], b["start_time"])
+    shorter = min(a["end_time"] - a["start_time"], b["end_time"] - b["start_time"])
+    if overlap <= 0 or shorter <= 0:
+        return 0
+    return overlap / shorter
+
+
+def merge_clips(clip_lists, duplicate_overlap=DUPLICATE_OVERLAP):
+    # Clips of all windows in start order, keeping the first of every group of
+    # clips that cover the same stretch of the video
+    merged = []
+    clips = sorted(
+        (clip for clips in clip_lists for clip in clips),
+        key=lambda clip: (clip["start_time"], clip["end_time"]),
+    )
+    for clip in clips:
+        if any(clip_overlap(clip, kept) > duplicate_overlap for kept in merged):
+            continue
+        merged.append(clip)
+    return merged
+
+
+def map_windows(windows, complete_window, concurrency=DEFAULT_CONCURRENCY):
+    # Runs complete_window on every window concurrently, returns the outputs
+    # in window order
+    windows = list(windows)
+    if not windows:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(windows)))) as executor:
+        return list(executor.map(metrics.bind(complete_window), windows))
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import functools
+import threading
+from contextlib import contextmanager
+
+# Lightweight instrumentation. Stages run in timed spans and amounts such as
+# frames rendered go to counters, both become events handed to every
+# registered sink. With no sink registered an event is dropped before it is
+# built, so the calls can stay in the hot paths.
+#
+# A sink is any callable taking an event dict:
+#
+#   add_sink(jsonl_sink("output/metrics.jsonl"))   one JSON object per line
+#   add_sink(stdout_sink)                           one readable line per event
+#   events = []; add_sink(events.append)            in memory
+#
+# Events carry the job they belong to, set for the current thread with
+# `with job(name):`, so summarize() can break the time down per job.
+
+_sinks = []
+_local = threading.local()
+
+
+def add_sink(sink):
+    _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+def jsonl_sink(path):
+    # One write per event on an O_APPEND descriptor, forked workers share the
+    # file without interleaving their lines
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def sink(event):
+        os.write(fd, (json.dumps(event, default=str) + "\n").encode("utf-8"))
+
+    return sink
+
+
+def format_event(event):
+    line = f"[{event.get('job') or '-'}] {event['name']}"
+    shown = ("type", "name", "job", "time", "pid")
+    if event["type"] == "span":
+        line += f" {event['status']} in {event['seconds']:.2f}s"
+        shown += ("status", "seconds")
+    elif event["type"] == "count":
+        line += f" +{event['value']}"
+        shown += ("value",)
+    for key, value in event.items():
+        if key not in shown and value is not None:
+            line += f" {key}={value}"
+    return line
+
+
+def stdout_sink(event):
+    print(format_event(event))
+
+
+def configure(target):
+    # "-" for stdout, otherwise a JSONL path. Returns the sink, None when
+    # target is empty and metrics stay off
+    if not target:
+        return None
+    return add_sink(stdout_sink if target == "-" else jsonl_sink(target))
+
+
+def enabled():
+    # For amounts that cost something to work out, such as token counts
+    return bool(_sinks)
+
+
+def current_job():
+    return getattr(_local, "job", None)
+
+
+@contextmanager
+def job(name):
+    previous = current_job()
+    _local.job = name
+    try:
+        yield
+    finally:
+        _local.job = previous
+
+
+def bind(function, name=None):
+    # function run under name, by default the caller's job, on whichever
+    # thread ends up calling it
+    name = current_job() if name is None else name
+
+    @functools.wraps(function)
+    def bound(*args, **kwargs):
+        with job(name):
+            return function(*args, **kwargs)
+
+    return bound
+
+
+def emit(event_type, name, **fields):
+    if not _sinks:
+        return
+    event = {
+        "type": event_type,
+        "name": name,
+        "job": current_job(),
+        "time": time.time(),
+        "pid": os.getpid(),
+    }
+    event.update(fields)
+    for sink in list(_sinks):
+        try:
+            sink(event)
+        except Exception as e:
+            # Metrics never take the pipeline down
+            print(f"Metrics sink failed: {e}")
+
+
+@contextmanager
+def span(name, **fields):
+    # fields is yielded so the body can add to it, e.g. a frame count
+    started = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as e:
+        emit(
+            "span",
+            name,
+            seconds=time.perf_counter() - started,
+            status="failed",
+            error=f"{type(e).__name__}: {e}",
+            **fields,
+        )
+        raise
+    emit("span", name, seconds=time.perf_counter() - started, status="ok", **fields)
+
+
+def timed(name):
+    # Decorator running the whole function in a span
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, value=1, **fields):
+    emit("count", name, value=value, **fields)
+
+
+def event(name, **fields):
+    emit("event", name, **fields)
+
+
+def load_events(path, since=None):
+    events = []
+    if not os.path.exists(path):
+        return events
+    with open(path) as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # A line cut short by a killed process
+                continue
+            if since is None or event.get("time", 0) >= since:
+                events.append(event)
+    return events
+
+
+def summarize(events):
+    # {job: {"spans": {name: {"count", "failed", "seconds"}},
+    #        "counters": {name: total}, "events": {name: count}}}. Span
+    # seconds include the spans nested in them.
+    summary = {}
+    for event in events:
+        totals = summary.setdefault(
+            event.get("job"), {"spans": {}, "counters": {}, "events": {}}
+        )
+        if event["type"] == "span":
+            span_totals = totals["spans"].setdefault(
+                event["name"], {"count": 0, "failed": 0, "seconds": 0.0}
+            )
+            span_totals["count"] += 1
+            span_totals["failed"] += event["status"] != "ok"
+            span_totals["seconds"] += event["seconds"]
+        elif event["type"] == "count":
+            totals["counters"][event["name"]] = (
+                totals["counters"].get(event["name"], 0) + event["value"]
+            )
+        else:
+            totals["events"][event["name"]] = totals["events"].get(event["name"], 0) + 1
+    return summary
+
+
+def print_summary(summary):
+    print("Metrics summary:")
+    for job_name, totals in summary.items():
+        print(f"  {job_name or '-'}")
+        for name, span_totals in sorted(
+            totals["spans"].items(), key=lambda item: -item[1]["seconds"]
+        ):
+            line = f"    {span_totals['seconds']:8.1f}s  {name} x{span_totals['count']}"
+            if span_totals["failed"]:
+                line += f" ({span_totals['failed']} failed)"
+            print(line)
+        for name, value in sorted(totals["counters"].items()):
+            print(f"    {value:>9}  {name}")
+        for name, value in sorted(totals["events"].items()):
+            print(f"    {value:>9}  {name} events")
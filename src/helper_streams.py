@@ -0,0 +1,91 @@
+import re
+
+# Source stream selection. YouTube serves a few low resolution progressive
+# streams and separate adaptive video and audio streams at every resolution.
+# Downloading more pixels than the render keeps costs download time and resize
+# time, so the smallest adaptive video stream that still covers the output
+# height is paired with the best audio stream and the two are muxed locally.
+#
+# select_streams works on plain metadata dicts rather than pytube objects so
+# recorded stream lists can be replayed offline.
+
+# Containers whose codecs ffmpeg can stream copy into the mp4 clips
+PREFERRED_SUBTYPE = "mp4"
+
+
+def get_target_height(config):
+    return int(config.get("output_resolution", "1080p").split("p")[0])
+
+
+def _number(value):
+    # "720p" -> 720, "128kbps" -> 128, None -> None
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    match = re.match(r"\d+", str(value))
+    return int(match.group()) if match else None
+
+
+def stream_metadata(stream):
+    # The fields select_streams needs from a pytube Stream, none of them
+    # trigger a network request
+    return {
+        "itag": stream.itag,
+        "mime_type": stream.mime_type,
+        "subtype": stream.subtype,
+        "progressive": stream.is_progressive,
+        "video": stream.includes_video_track,
+        "audio": stream.includes_audio_track,
+        "height": _number(stream.resolution),
+        "fps": stream.fps if stream.includes_video_track else None,
+        "abr": _number(stream.abr),
+        "bitrate": stream.bitrate,
+    }
+
+
+def _video_rank(stream, target_height):
+    # Streams covering the target height first, then the smallest of those
+    # (or the largest of the rest), mp4 before webm, then the lowest bitrate
+    height = stream["height"] or 0
+    covers = height >= target_height
+    return (
+        not covers,
+        height if covers else -height,
+        stream["subtype"] != PREFERRED_SUBTYPE,
+        stream["fps"] or 0,
+        stream["bitrate"] or 0,
+    )
+
+
+def _audio_rank(stream):
+    return (
+        stream["subtype"] != PREFERRED_SUBTYPE,
+        -(stream["abr"] or 0),
+        -(stream["bitrate"] or 0),
+    )
+
+
+def select_streams(streams, target_height):
+    # Returns {"video": metadata, "audio": metadata or None}. audio is None
+    # when the chosen video stream is progressive and already has sound.
+    adaptive_video = [s for s in streams if s["video"] and not s["audio"] and s["height"]]
+    adaptive_audio = [s for s in streams if s["audio"] and not s["video"]]
+    progressive = [s for s in streams if s["video"] and s["audio"] and s["height"]]
+
+    if adaptive_video and adaptive_audio:
+        return {
+            "video": min(adaptive_video, key=lambda s: _video_rank(s, target_height)),
+            "audio": min(adaptive_audio, key=_audio_rank),
+        }
+    if progressive:
+        return {
+            "video": min(progressive, key=lambda s: _video_rank(s, target_height)),
+            "audio": None,
+        }
+    if adaptive_video:
+        return {
+            "video": min(adaptive_video, key=lambda s: _video_rank(s, target_height)),
+            "audio": None,
+        }
+    raise ValueError("No video stream available")
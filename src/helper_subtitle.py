@@ -2,40 +2,71 @@ import os
 import json
 import uuid
 import ffmpeg
+from fractions import Fraction
+from functools import lru_cache
 import numpy as np
-from PIL import Image, ImageDraw
-from faster_whisper import WhisperModel
-from moviepy.editor import (
-    TextClip,
-    CompositeVideoClip,
-    VideoFileClip,
-    ColorClip,
-    ImageClip,
+import helper_metrics as metrics
+from helper_glyph import (
+    get_font,
+    render_word,
+    measure_word,
 )
+from helper_lines import split_words, expand_subtitles
+from helper_caption import (
+    get_caption_styles,
+    layout_caption,
+    get_highlight_sprite,
+)
+from helper_compositor import (
+    build_caption_layers,
+    OverlaySchedule,
+    StreamingSchedule,
+    blend_layers,
+)
+from helper_cache import (
+    DEFAULT_MAX_GB,
+    hash_key,
+    hash_file,
+    load_json,
+    store_json,
+    store_file,
+    restore_file,
+    load_manifest,
+    update_manifest,
+    evict,
+)
+from helper_transcribe import (
+    get_whisper_config,
+    transcribe,
+    transcribe_clips,
+    transcribe_source,
+    slice_word_timeline,
+)
+from helper_batch import run_in_workers, run_task, fit_workers
+from helper_ass import ass_supported, write_ass, burn_ass
+from helper_video import (
+    probe_video,
+    get_output_geometry,
+    get_encoder_config,
+    get_scale_filter,
+    resize_and_crop,
+    render_frames,
+    render_frames_split,
+)
+from helper_variants import get_output_variants, select_variants, get_variant_path
 
-# Create an image with rounded corners using PIL
-
-with open("fontConfig.json") as f:
-    font_config_list = json.load(f)
-
+FONT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fontConfig.json")
 
-def create_rounded_image(size, radius, color, opacity):
-    width, height = size
-    # Parse the color and apply the opacity
-    r, g, b = color
-    color_with_opacity = (r, g, b, int(255 * opacity))  # Opacity is scaled to 0-255
 
-    # Create an RGBA image to accommodate opacity
-    image = Image.new("RGBA", (width, height), (0, 0, 0, 0))  # Transparent background
-    draw = ImageDraw.Draw(image)
-    draw.rounded_rectangle(
-        [0, 0, width, height], radius=radius, fill=color_with_opacity
-    )
-    return image
+@lru_cache(maxsize=None)
+def load_font_configs():
+    # Read on first use, next to this module rather than the cwd
+    with open(FONT_CONFIG_PATH) as f:
+        return json.load(f)
 
 
-model_size = "medium"
-model = WhisperModel(model_size)
+def get_font_config(config):
+    return load_font_configs()[config.get("font_config_id", "1")]
 
 
 def extract_audio_from_video(video_path, audio_path):
@@ -44,290 +75,103 @@ def extract_audio_from_video(video_path, audio_path):
         audio = input_stream.audio
         output_stream = ffmpeg.output(audio, audio_path, loglevel="quiet")
         output_stream = ffmpeg.overwrite_output(output_stream)
+        metrics.count("ffmpeg_processes")
         ffmpeg.run(output_stream)
     except Exception as e:
         print(f"An error occurred: {e}")
 
 
-def extract_text_from_audio(audio_path):
-    segments, info = model.transcribe(audio_path, word_timestamps=True)
-    segments = list(segments)
-    wordlevel_info = []
-    for segment in segments:
-        for word in segment.words:
-            wordlevel_info.append(
-                {"word": word.word, "start": float(word.start), "end": float(word.end)}
-            )
-    return wordlevel_info
+def extract_text_from_audio(audio_path, config=None):
+    return transcribe(audio_path, config)
 
 
 def split_text_into_lines(data, subtitle_config):
-    max_chars = subtitle_config.get("max_chars", 30)
-    max_duration = subtitle_config.get("max_duration", 2.5)
-    max_gap = subtitle_config.get("max_gap", 1.5)
-
-    subtitles = []
-    line = []
-    line_duration = 0
-    line_chars = 0
-
-    for idx, word_data in enumerate(data):
-        word = word_data["word"]
-        start = word_data["start"]
-        end = word_data["end"]
-
-        line.append(word_data)
-        line_duration += end - start
-
-        temp = " ".join(item["word"] for item in line)
-
-        # Check if adding a new word exceeds the maximum character count or duration
-        new_line_chars = len(temp)
-
-        duration_exceeded = line_duration > max_duration
-        chars_exceeded = new_line_chars > max_chars
-        if idx > 0:
-            gap = word_data["start"] - data[idx - 1]["end"]
-            #   print (word,start,end,gap)
-            maxgap_exceeded = gap > max_gap
-        else:
-            maxgap_exceeded = False
-
-        if duration_exceeded or chars_exceeded or maxgap_exceeded:
-            if line:
-                subtitle_line = {
-                    "word": " ".join(item["word"] for item in line),
-                    "start": line[0]["start"],
-                    "end": line[-1]["end"],
-                    "textcontents": line,
-                }
-                subtitles.append(subtitle_line)
-                line = []
-                line_duration = 0
-                line_chars = 0
-
-    if line:
-        subtitle_line = {
-            "word": " ".join(item["word"] for item in line),
-            "start": line[0]["start"],
-            "end": line[-1]["end"],
-            "textcontents": line,
-        }
-        subtitles.append(subtitle_line)
-
+    return expand_subtitles(split_words(data, subtitle_config))
+
+
+def get_split_measure(wordlevel_info, config):
+    # Pixel widths for splitting lines on the rendered width, measured with
+    # the caption font at the nominal output size. None unless the subtitle
+    # config sets max_width_factor, a share of the frame width.
+    max_width_factor = (config.get("subtitle_config") or {}).get("max_width_factor")
+    if not max_width_factor:
+        return None
+    font_config = get_font_config(config)
+    output_height = int(config.get("output_resolution", "1080p").split("p")[0])
+    aspect_ratio = config.get("video_aspect_ratio", [9, 16])
+    frame_width = int(output_height * aspect_ratio[0] / aspect_ratio[1])
+    styles = get_caption_styles((frame_width, output_height), font_config)
+    space_width, _ = measure_word(font_config["spacing"]["text"], styles["spacing"])
+    widths = []
+    for word in wordlevel_info:
+        text = word["word"].upper() if font_config["uppercase"] else word["word"]
+        widths.append(measure_word(text, styles["normal"])[0])
+    return widths, frame_width * max_width_factor, space_width
+
+
+def write_subtitles(subtitles_path, wordlevel_info, config):
+    subtitles = split_words(
+        wordlevel_info,
+        config.get("subtitle_config") or {},
+        get_split_measure(wordlevel_info, config),
+    )
+    with open(subtitles_path, "w") as f:
+        json.dump(subtitles, f)
     return subtitles
 
 
-def create_caption(text_json, frame_size, config):
-    font_config_id = config.get("font_config_id", "1")
-
-    font_config = font_config_list[font_config_id]
-
-    wordcount = len(text_json["textcontents"])
-    full_duration = text_json["end"] - text_json["start"]
-
-    word_clips = []
-    xy_textclips_positions = []
+def get_subtitle_key(word_key, config):
+    parts = ["subtitles", word_key, config.get("subtitle_config")]
+    if (config.get("subtitle_config") or {}).get("max_width_factor"):
+        # Pixel width splitting depends on the font and the output size
+        parts += [
+            get_font_config(config),
+            config.get("output_resolution"),
+            config.get("video_aspect_ratio"),
+        ]
+    return hash_key(*parts)
 
-    x_pos = 0
-    y_pos = 0
-    line_width = 0  # Total width of words in the current line
-    frame_width = frame_size[0]
-    frame_height = frame_size[1]
 
-    x_buffer = frame_width * 1 / 10
-
-    max_line_width = frame_width - 2 * (x_buffer)
+def create_caption(text_json, frame_size, config):
+    from moviepy.editor import ImageClip
 
-    fontsize = int(frame_height * font_config["font_size_factor"])
+    font_config = get_font_config(config)
 
-    space_width = ""
-    space_height = ""
+    styles = get_caption_styles(frame_size, font_config)
+    xy_textclips_positions = layout_caption(text_json, frame_size, font_config)
 
-    for index, word_json in enumerate(text_json["textcontents"]):
-        duration = word_json["end"] - word_json["start"]
-        normal_word_duration = full_duration
-        normal_word_start = text_json["start"]
-        if font_config["words_on_the_go"]:
-            normal_word_duration = text_json["end"] - word_json["end"]
-            normal_word_start = word_json["end"]
-        
-        if font_config["uppercase"]:
-            word_json["word"] = word_json["word"].upper()
+    word_clips = []
 
+    for position in xy_textclips_positions:
         word_clip = (
-            TextClip(
-                word_json["word"],
-                font=font_config["normal"]["font"],
-                fontsize=fontsize * font_config["normal"]["font_size_factor"],
-                color=font_config["normal"]["color"],
-                stroke_color=font_config["normal"]["stroke_color"],
-                stroke_width=font_config["normal"]["stroke_width"],
-            )
-            .set_start(normal_word_start)
-            .set_duration(normal_word_duration)
-        )
-        word_clip_space = (
-            TextClip(
-                font_config["spacing"]["text"],
-                font=font_config["spacing"]["text"],
-                fontsize=fontsize * font_config["spacing"]["font_size_factor"],
-                color=font_config["spacing"]["color"],
-            )
-            .set_start(normal_word_start)
-            .set_duration(normal_word_duration)
+            ImageClip(render_word(position["word"], styles["normal"]))
+            .set_start(position["normal_start"])
+            .set_duration(position["normal_duration"])
+            .set_position((position["x_pos"], position["y_pos"]))
         )
-        word_width, word_height = word_clip.size
-        space_width, space_height = word_clip_space.size
-        if line_width + word_width + space_width <= max_line_width:
-            # Store info of each word_clip created
-            xy_textclips_positions.append(
-                {
-                    "x_pos": x_pos,
-                    "y_pos": y_pos,
-                    "width": word_width,
-                    "height": word_height,
-                    "word": word_json["word"],
-                    "start": word_json["start"],
-                    "end": word_json["end"],
-                    "duration": duration,
-                }
-            )
-
-            word_clip = word_clip.set_position((x_pos, y_pos))
-            word_clip_space = word_clip_space.set_position((x_pos + word_width, y_pos))
-
-            x_pos = x_pos + word_width + space_width
-            line_width = line_width + word_width + space_width
-        else:
-            # Move to the next line
-            x_pos = 0
-            y_pos = y_pos + word_height + 10
-            line_width = word_width + space_width
-
-            # Store info of each word_clip created
-            xy_textclips_positions.append(
-                {
-                    "x_pos": x_pos,
-                    "y_pos": y_pos,
-                    "width": word_width,
-                    "height": word_height,
-                    "word": word_json["word"],
-                    "start": word_json["start"],
-                    "end": word_json["end"],
-                    "duration": duration,
-                }
-            )
-
-            word_clip = word_clip.set_position((x_pos, y_pos))
-            word_clip_space = word_clip_space.set_position((x_pos + word_width, y_pos))
-            x_pos = word_width + space_width
-
         word_clips.append(word_clip)
-        word_clips.append(word_clip_space)
 
     for highlight_word in xy_textclips_positions:
-        # Define the size, corner radius, color, and opacity from the configuration
-        size = (
-            int(
-                highlight_word["width"]
-                * 1.1
-                * font_config["highlighted"]["font_size_factor"]
-            ),
-            int(
-                highlight_word["height"]
-                * 1.1
-                * font_config["highlighted"]["font_size_factor"]
-            ),
-        )
-        radius = font_config["highlighted"]["back_ground_color_clip"]["radius"]
-        color = font_config["highlighted"]["back_ground_color_clip"][
-            "color"
-        ]  # Expecting an (R, G, B) tuple
-        opacity = font_config["highlighted"]["back_ground_color_clip"]["opacity"]
-        # Create the rounded background clip
-        rounded_image = create_rounded_image(size, radius, color, opacity)
-        background_clip = ImageClip(np.array(rounded_image))
-
-        # Create a text clip
-        text_clip = TextClip(
-            highlight_word["word"],
-            font=font_config["highlighted"]["font"],
-            fontsize=fontsize * font_config["highlighted"]["font_size_factor"],
-            color=font_config["highlighted"]["color"],
-            stroke_color=font_config["highlighted"]["stroke_color"],
-            stroke_width=font_config["highlighted"]["stroke_width"],
-        )
-
-        # Calculate the position to center the text in the background clip
-        text_position = (
-            (background_clip.size[0] - text_clip.size[0]) / 2,
-            (background_clip.size[1] - text_clip.size[1]) / 2,
-        )
-
-        # Set the position of the text clip
-        text_clip = text_clip.set_position("center")
-
-        # Create a composite video clip
-        composite_clip = CompositeVideoClip([background_clip, text_clip])
-
-        # Set position of the entire composition based on x and y
-        final_clip = composite_clip.set_position(
-            (highlight_word["x_pos"], highlight_word["y_pos"])
+        # Background and text are blitted into a single RGBA sprite, already
+        # rotated, so moviepy never rotates a frame
+        sprite, x, y = get_highlight_sprite(
+            highlight_word, styles["highlighted"], font_config
         )
-        final_clip = final_clip.set_start(highlight_word["start"]).set_duration(
-            highlight_word["duration"]
+        final_clip = (
+            ImageClip(sprite)
+            .set_position((x, y))
+            .set_start(highlight_word["start"])
+            .set_duration(highlight_word["duration"])
         )
-
-        # add random rotation
-        final_clip = final_clip.rotate(
-            np.random.uniform(
-                -font_config["highlighted"]["rotate_random_degree"],
-                font_config["highlighted"]["rotate_random_degree"],
-            ),
-            resample="bicubic",
-        )
-
-        # Append the composite clip to the list
         word_clips.append(final_clip)
 
     return word_clips, xy_textclips_positions
 
 
-def add_subtitles(video_path, linelevel_subtitles, config):
-    name = config.get("name", uuid.uuid4().hex)
-    output_resolution = config.get("output_resolution", "1080p")
-    video_aspect_ratio = config.get("video_aspect_ratio", [9, 16])
-    font_configId = config.get("font_config_id", "1")
-    font_config = font_config_list[font_configId]
+def overlay_captions_moviepy(input_video, linelevel_subtitles, frame_size, config):
+    from moviepy.editor import CompositeVideoClip, ColorClip
 
-    video_name = os.path.basename(video_path)
-    base_path = os.path.join(os.getcwd(), "output", name, "final")
-    os.makedirs(base_path, exist_ok=True)
-    output_path = os.path.join(base_path, video_name)
-
-    input_video = VideoFileClip(video_path)
-    frame_size = input_video.size
-    scale_factor = int(output_resolution.split("p")[0]) / frame_size[1]
-    input_video = input_video.resize(scale_factor)
-    frame_size = input_video.size
-
-    new_width = int(frame_size[1] * video_aspect_ratio[0] / video_aspect_ratio[1])
-    if new_width % 2 != 0:
-        new_width -= 1
-
-    x_offset = (frame_size[0] - new_width) // 2
-    if x_offset % 2 != 0:
-        x_offset -= 1
-
-    input_video = input_video.crop(
-        x1=x_offset,
-        y1=0,
-        width=new_width,
-        height=frame_size[1],
-    )
-
-    frame_size = input_video.size
+    font_config = get_font_config(config)
 
     all_linelevel_splits = []
 
@@ -357,10 +201,7 @@ def add_subtitles(video_path, linelevel_subtitles, config):
             line["end"] - line["start"]
         )
 
-        # centered_clips = [each.set_position('center') for each in out_clips]
-
         clip_to_overlay = CompositeVideoClip([color_clip] + out_clips)
-        clip_to_overlay = clip_to_overlay.set_position("bottom")
         clip_to_overlay = clip_to_overlay.set_position(
             (
                 "center",
@@ -372,18 +213,159 @@ def add_subtitles(video_path, linelevel_subtitles, config):
 
         all_linelevel_splits.append(clip_to_overlay)
 
-    final_video = CompositeVideoClip([input_video] + all_linelevel_splits)
+    return CompositeVideoClip([input_video] + all_linelevel_splits)
+
+
+@metrics.timed("add_subtitles")
+def add_subtitles(video_path, linelevel_subtitles, config):
+    # Renders every output variant of the config, the numpy renderer decodes
+    # the clip once for all of them. Returns the render stats of a single
+    # output, or a list with the stats of every variant.
+    # Subtitles in either the compact or the older line format
+    linelevel_subtitles = expand_subtitles(linelevel_subtitles)
+    name = config.get("name", uuid.uuid4().hex)
+
+    video_name = os.path.basename(video_path)
+    base_path = os.path.join(os.getcwd(), "output", name, "final")
+    subtitles_path = os.path.join(os.getcwd(), "output", name, "subtitles")
+
+    info = probe_video(video_path)
+    outputs = []
+    for variant_name, variant_config in get_output_variants(config):
+        output_path = get_variant_path(base_path, variant_name, video_name)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        suffix = ".ass" if variant_name is None else f".{variant_name}.ass"
+        ass_path = os.path.join(subtitles_path, video_name.replace(".mp4", suffix))
+        output = prepare_output(
+            video_path, output_path, ass_path, linelevel_subtitles, info, variant_config
+        )
+        if output is not None:
+            outputs.append(output)
+
+    if not outputs:
+        return None
+    schedules = [output.pop("schedule") for output in outputs]
+    if len(outputs) > 1 and os.name == "posix":
+        stats = render_frames_split(video_path, outputs)
+    else:
+        stats = [render_frames(video_path, **output) for output in outputs]
+    for output, schedule in zip(outputs, schedules):
+        if isinstance(schedule, StreamingSchedule):
+            # What the caption layers actually held, to size render_memory_mb by
+            metrics.event(
+                "caption_memory",
+                output=os.path.relpath(output["output_path"], base_path),
+                peak_mb=round(schedule.peak_bytes / (1024 * 1024), 2),
+                render_memory_mb=config.get("render_memory_mb"),
+            )
+    return stats[0] if len(stats) == 1 else stats
+
+
+def prepare_output(video_path, output_path, ass_path, linelevel_subtitles, info, config):
+    # The ASS and moviepy backends render right away and return None, the
+    # numpy renderer returns the render_frames arguments of the output and
+    # its caption schedule
+    font_configId = config.get("font_config_id", "1")
+    font_config = get_font_config(config)
+    geometry = get_output_geometry(
+        info["width"],
+        info["height"],
+        config.get("output_resolution", "1080p"),
+        config.get("video_aspect_ratio", [9, 16]),
+    )
+    frame_size = (geometry["width"], geometry["height"])
+
+    render_backend = config.get("render_backend", "numpy")
+    if render_backend == "ass":
+        if ass_supported(font_config):
+            write_ass(ass_path, linelevel_subtitles, frame_size, font_config)
+            burn_ass(video_path, output_path, ass_path, info, geometry, font_config, config)
+            return None
+        print(
+            f"Font config {font_configId} uses features ASS cannot express, "
+            "falling back to the numpy renderer"
+        )
+
+    if render_backend == "moviepy":
+        add_subtitles_moviepy(
+            video_path, output_path, linelevel_subtitles, geometry, info, config
+        )
+        return None
+
+    if config.get("stream_captions", True):
+        schedule = StreamingSchedule(linelevel_subtitles, frame_size, font_config)
+    else:
+        schedule = OverlaySchedule(
+            build_caption_layers(linelevel_subtitles, frame_size, font_config)
+        )
+
+    if config.get("resize_backend", "ffmpeg") == "python":
+        output_frame = np.empty((frame_size[1], frame_size[0], 3), dtype=np.uint8)
+
+        def process_frame(frame, t):
+            frame = resize_and_crop(frame, geometry, output_frame)
+            return blend_layers(frame, schedule.active_at(t), schedule.scratch)
+
+        return {
+            "output_path": output_path,
+            "process_frame": process_frame,
+            "config": config,
+            "video_filter": None,
+            "frame_size": None,
+            "schedule": schedule,
+        }
+
+    # Crop and scale at decode time so only output sized frames reach Python
+    return {
+        "output_path": output_path,
+        "process_frame": lambda frame, t: blend_layers(
+            frame, schedule.active_at(t), schedule.scratch
+        ),
+        "config": config,
+        "video_filter": get_scale_filter(info, geometry),
+        "frame_size": frame_size,
+        "schedule": schedule,
+    }
+
+
+def add_subtitles_moviepy(video_path, output_path, linelevel_subtitles, geometry, info, config):
+    from moviepy.editor import VideoFileClip
+
+    encoder_config = get_encoder_config(config, info)
+
+    input_video = VideoFileClip(video_path)
+    input_video = input_video.resize(
+        (geometry["scaled_width"], geometry["scaled_height"])
+    )
+    input_video = input_video.crop(
+        x1=geometry["x_offset"],
+        y1=0,
+        width=geometry["width"],
+        height=geometry["height"],
+    )
+
+    final_video = overlay_captions_moviepy(
+        input_video, linelevel_subtitles, input_video.size, config
+    )
 
     # Set the audio of the final video to be the same as the input video
     final_video = final_video.set_audio(input_video.audio)
 
     # Save the final clip as a video file with the audio included
-    final_video.write_videofile(output_path, fps=24, codec="libx264", audio_codec="aac")
+    final_video.write_videofile(
+        output_path,
+        fps=float(Fraction(encoder_config["fps"])),
+        codec="libx264",
+        audio_codec="aac",
+        preset=encoder_config["preset"],
+        threads=encoder_config["threads"] or None,
+        ffmpeg_params=["-crf", str(encoder_config["crf"])],
+    )
 
 
+@metrics.timed("render_clip")
 def add_subtitles_to_video(video_name, config):
     name = config.get("name")
-    subtitle_config = config.get("subtitle_config")
 
     base_path = os.path.join(os.getcwd(), "output", name)
     video_path = os.path.join(base_path, "clips", video_name)
@@ -399,18 +381,153 @@ def add_subtitles_to_video(video_name, config):
         add_subtitles(video_path, linelevel_subtitles, config)
         return
 
-    extract_audio_from_video(video_path, audio_path)
-    print("Extracted audio from video")
-    wordlevel_info = extract_text_from_audio(audio_path)
+    if config.get("keep_audio"):
+        # Debug artifact only, transcription decodes the clip itself
+        extract_audio_from_video(video_path, audio_path)
+        print("Extracted audio from video")
+    wordlevel_info = extract_text_from_audio(video_path, config)
     print("Extracted text from audio")
-    linelevel_subtitles = split_text_into_lines(wordlevel_info, subtitle_config)
-    with open(subtitles_path, "w") as f:
-        json.dump(linelevel_subtitles, f)
+    linelevel_subtitles = write_subtitles(subtitles_path, wordlevel_info, config)
     print("Split text into lines")
     add_subtitles(video_path, linelevel_subtitles, config)
     print("Added subtitles to video")
 
 
+def uses_source_timeline(config):
+    # Source words are rebased on the planned clip start. A stream copied
+    # clip starts on the keyframe before it, so its captions would run early
+    # by up to one GOP.
+    return bool(config.get("transcribe_source")) and config.get("cut_mode", "copy") != "copy"
+
+
+def load_source_timeline(config):
+    # With transcribe_source the downloaded source video is transcribed once
+    # and every clip takes its words from that timeline
+    if not uses_source_timeline(config):
+        if config.get("transcribe_source"):
+            print('transcribe_source needs cut_mode "accurate" or "smart", transcribing clips individually')
+        return None, {}
+    base_path = os.path.join(os.getcwd(), "output", config.get("name"))
+    llm_output_path = os.path.join(base_path, "llmOutput.json")
+    if not os.path.exists(llm_output_path):
+        return None, {}
+    with open(llm_output_path) as f:
+        llm_output = json.load(f)
+    source_video = llm_output.get("source_video")
+    if not source_video or not os.path.exists(source_video):
+        print("Source video not found, transcribing clips individually")
+        return None, {}
+
+    manifest = load_manifest(config.get("name"))
+    timeline_key = hash_key(
+        "timeline",
+        manifest.get("download") or hash_file(source_video),
+        get_whisper_config(config),
+    )
+    timeline = transcribe_source(source_video, timeline_key, config)
+    clip_times = {
+        f"{clip['title']}.mp4": (clip["start_time"], clip["end_time"])
+        for clip in llm_output["clips"]
+    }
+    return timeline, clip_times
+
+
+def get_clip_keys(clips, config):
+    # Clips cut by get_clips are keyed in the manifest, anything else by content
+    base_path_clips = os.path.join(os.getcwd(), "output", config.get("name"), "clips")
+    manifest_clips = load_manifest(config.get("name")).get("clips", {})
+    return {
+        clip: manifest_clips.get(clip)
+        or hash_key("clip-file", hash_file(os.path.join(base_path_clips, clip)))
+        for clip in clips
+    }
+
+
+@metrics.timed("prepare_subtitles")
+def prepare_subtitles(clip_keys, config):
+    # Word timings are cached per clip and Whisper config, line splits are
+    # recomputed from them and written to subtitles/ for the renderers
+    name = config.get("name")
+    base_path = os.path.join(os.getcwd(), "output", name)
+
+    word_keys = {
+        clip: hash_key(
+            "words",
+            clip_key,
+            get_whisper_config(config),
+            uses_source_timeline(config),
+        )
+        for clip, clip_key in clip_keys.items()
+    }
+    words = {clip: load_json("words", key) for clip, key in word_keys.items()}
+    missing = [clip for clip, value in words.items() if value is None]
+
+    if missing:
+        timeline, clip_times = load_source_timeline(config)
+        pending = {}
+        for video_name in missing:
+            if video_name in clip_times:
+                # Cut this clip's words out of the full source transcript
+                words[video_name] = slice_word_timeline(
+                    timeline, *clip_times[video_name]
+                )
+                continue
+            video_path = os.path.join(base_path, "clips", video_name)
+            if config.get("keep_audio"):
+                audio_path = os.path.join(
+                    base_path, "audio", video_name.replace(".mp4", ".mp3")
+                )
+                extract_audio_from_video(video_path, audio_path)
+            pending[video_path] = video_name
+
+        # Audio is decoded to PCM in memory and handed to the model directly
+        for video_path, wordlevel_info, error in transcribe_clips(pending, config):
+            if error is not None:
+                print(f"Failed to transcribe {video_path}: {error}")
+                continue
+            words[pending[video_path]] = wordlevel_info
+            print(f"Transcribed {os.path.basename(video_path)}")
+
+        for video_name in missing:
+            if words[video_name] is not None:
+                store_json("words", word_keys[video_name], words[video_name])
+
+    subtitle_keys = {}
+    for video_name, wordlevel_info in words.items():
+        subtitles_path = os.path.join(
+            base_path, "subtitles", video_name.replace(".mp4", ".json")
+        )
+        if wordlevel_info is None:
+            # Let the renderer transcribe it rather than use stale subtitles
+            if os.path.exists(subtitles_path):
+                os.remove(subtitles_path)
+            continue
+        write_subtitles(subtitles_path, wordlevel_info, config)
+        subtitle_keys[video_name] = get_subtitle_key(word_keys[video_name], config)
+    return word_keys, subtitle_keys
+
+
+def get_render_key(clip_key, subtitle_key, config):
+    font_config = get_font_config(config)
+    return hash_key(
+        "render",
+        clip_key,
+        subtitle_key,
+        font_config,
+        {
+            key: config.get(key)
+            for key in (
+                "output_resolution",
+                "video_aspect_ratio",
+                "render_backend",
+                "resize_backend",
+                "encoder_config",
+            )
+        },
+    )
+
+
+@metrics.timed("render")
 def add_subtitles_to_clips(config):
     name = config.get("name")
     cwd = os.getcwd()
@@ -420,14 +537,123 @@ def add_subtitles_to_clips(config):
     base_path_subtitles = os.path.join(cwd, "output", name, "subtitles")
 
     os.makedirs(base_path_final, exist_ok=True)
-    os.makedirs(base_path_audio, exist_ok=True)
+    if config.get("keep_audio"):
+        os.makedirs(base_path_audio, exist_ok=True)
     os.makedirs(base_path_clips, exist_ok=True)
     os.makedirs(base_path_subtitles, exist_ok=True)
 
-    clips = os.listdir(base_path_clips)
-    final_clips = os.listdir(base_path_final)
-
-    clips_to_process = list(set(clips) - set(final_clips))
+    clips = sorted(os.listdir(base_path_clips))
+    clip_keys = get_clip_keys(clips, config)
+
+    # Transcription runs here with one shared model so render workers never
+    # load Whisper themselves
+    word_keys, subtitle_keys = prepare_subtitles(clip_keys, config)
+
+    # Renders are cached per output variant, a clip is rendered again for
+    # the variants that are not in the cache. render_keys are keyed by the
+    # output path relative to final/.
+    variants = get_output_variants(config)
+    render_keys = {}
+    clips_to_process = []
+    missing_variants = {}
+    for clip in clips:
+        missing = []
+        for variant_name, variant_config in variants:
+            if clip not in subtitle_keys:
+                missing.append(variant_name)
+                continue
+            output = get_variant_path("", variant_name, clip)
+            render_keys[output] = get_render_key(
+                clip_keys[clip], subtitle_keys[clip], variant_config
+            )
+            final_path = os.path.join(base_path_final, output)
+            if restore_file("renders", render_keys[output], final_path, ".mp4"):
+                print(f"Using cached render for {output}")
+            else:
+                missing.append(variant_name)
+        if missing:
+            clips_to_process.append(clip)
+            missing_variants[clip] = missing
     print(f"Clips to process: {clips_to_process}")
-    for clip in clips_to_process:
-        add_subtitles_to_video(clip, config)
+
+    workers = config.get("render_workers", 1)
+    # Only start as many renders as fit in memory at their budget each
+    memory_mb = config.get("render_memory_mb")
+    fitted = fit_workers(workers, memory_mb)
+    if fitted < workers:
+        print(f"Running {fitted} render workers to stay within {memory_mb} MB each")
+        workers = fitted
+    tasks = [
+        (clip, select_variants(config, missing_variants[clip]))
+        for clip in clips_to_process
+    ]
+    if workers > 1 and len(tasks) > 1:
+        records = run_in_workers(
+            render_clip,
+            tasks,
+            workers,
+            initializer=warm_render_worker,
+            initargs=(config,),
+            max_tasks_per_worker=config.get("max_clips_per_worker"),
+        )
+    else:
+        records = [run_task(render_clip, task) for task in tasks]
+
+    for clip, record in zip(clips_to_process, records):
+        metrics.event(
+            "clip_rendered",
+            clip=clip,
+            status=record["status"],
+            seconds=round(record["seconds"], 2),
+            error=record.get("error"),
+        )
+        if record["status"] != "ok":
+            continue
+        for variant_name in missing_variants[clip]:
+            output = get_variant_path("", variant_name, clip)
+            if output in render_keys:
+                store_file(
+                    "renders",
+                    render_keys[output],
+                    os.path.join(base_path_final, output),
+                    ".mp4",
+                )
+
+    update_manifest(
+        name,
+        words=word_keys,
+        subtitles=subtitle_keys,
+        renders=render_keys,
+    )
+    evict(config.get("cache_max_gb", DEFAULT_MAX_GB))
+
+    print_render_summary(clips_to_process, records)
+    return records
+
+
+def warm_render_worker(config):
+    # Resolve and open the caption fonts of every variant once per worker
+    # process
+    for _, variant_config in get_output_variants(config):
+        font_config = get_font_config(variant_config)
+        output_height = int(variant_config.get("output_resolution", "1080p").split("p")[0])
+        styles = get_caption_styles((0, output_height), font_config)
+        for section in ("normal", "spacing", "highlighted"):
+            get_font(styles[section][0], styles[section][1])
+
+
+def render_clip(task):
+    clip, config = task
+    add_subtitles_to_video(clip, config)
+    return clip
+
+
+def print_render_summary(clips, records):
+    print("Render summary:")
+    for clip, record in zip(clips, records):
+        line = f"  {record['status']:<8} {record['seconds']:7.1f}s  {clip}"
+        if record.get("error"):
+            line += f"  ({record['error']})"
+        print(line)
+    failed = sum(1 for record in records if record["status"] != "ok")
+    print(f"Rendered {len(records) - failed}/{len(records)} clips")
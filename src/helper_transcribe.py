@@ -0,0 +1,194 @@
+import os
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import helper_metrics as metrics
+from helper_cache import entry_path, lookup
+
+# One WhisperModel per process, loaded on first use. CTranslate2 releases the
+# GIL, so several clips are transcribed concurrently from threads sharing the
+# same model weights (num_workers), each through its own instance of
+# faster-whisper's batched VAD-chunked pipeline when it is available.
+
+DEFAULT_WHISPER_CONFIG = {
+    "model_size": "medium",
+    "device": "cpu",
+    "compute_type": "int8",
+    "cpu_threads": 0,
+    "concurrency": 2,
+    "batch_size": 8,
+    "vad_filter": True,
+}
+
+SAMPLING_RATE = 16000
+
+_models = {}
+_lock = threading.Lock()
+
+
+def get_whisper_config(config=None):
+    whisper_config = dict(DEFAULT_WHISPER_CONFIG)
+    whisper_config.update((config or {}).get("whisper_config", {}))
+    return whisper_config
+
+
+def _model_key(whisper_config):
+    return (
+        whisper_config["model_size"],
+        whisper_config["device"],
+        whisper_config["compute_type"],
+        whisper_config["cpu_threads"],
+        whisper_config["concurrency"],
+    )
+
+
+def get_model(config=None):
+    whisper_config = get_whisper_config(config)
+    key = _model_key(whisper_config)
+    with _lock:
+        if key not in _models:
+            from faster_whisper import WhisperModel
+
+            print(f"Loading Whisper model {whisper_config['model_size']}")
+            _models[key] = WhisperModel(
+                whisper_config["model_size"],
+                device=whisper_config["device"],
+                compute_type=whisper_config["compute_type"],
+                cpu_threads=whisper_config["cpu_threads"],
+                num_workers=max(1, whisper_config["concurrency"]),
+            )
+    return _models[key]
+
+
+def get_pipeline(config=None):
+    # A new batched pipeline over the shared model for every transcription,
+    # None when batching is disabled or faster-whisper is too old. The
+    # pipeline keeps per transcription state (last_speech_timestamp), so it
+    # must not be shared between threads, the model can be.
+    whisper_config = get_whisper_config(config)
+    if whisper_config["batch_size"] <= 1:
+        return None
+    try:
+        from faster_whisper import BatchedInferencePipeline
+    except ImportError:
+        return None
+    return BatchedInferencePipeline(model=get_model(config))
+
+
+def load_audio(media_path, sampling_rate=SAMPLING_RATE):
+    # Decode any audio or video file straight to mono float32 PCM, without an
+    # intermediate audio file
+    command = [
+        "ffmpeg",
+        "-v", "error",
+        "-nostdin",
+        "-i", media_path,
+        "-vn",
+        "-ac", "1",
+        "-ar", str(sampling_rate),
+        "-f", "f32le",
+        "-",
+    ]
+    metrics.count("ffmpeg_processes")
+    result = subprocess.run(command, stdout=subprocess.PIPE, check=True)
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+
+@metrics.timed("transcribe")
+def transcribe(audio, config=None):
+    # audio is a media file path or a 16 kHz mono float32 array
+    whisper_config = get_whisper_config(config)
+    if isinstance(audio, str):
+        audio = load_audio(audio)
+    pipeline = get_pipeline(config)
+    if pipeline is not None:
+        segments, info = pipeline.transcribe(
+            audio, word_timestamps=True, batch_size=whisper_config["batch_size"]
+        )
+    else:
+        segments, info = get_model(config).transcribe(
+            audio, word_timestamps=True, vad_filter=whisper_config["vad_filter"]
+        )
+
+    wordlevel_info = []
+    for segment in segments:
+        for word in segment.words:
+            wordlevel_info.append(
+                {"word": word.word, "start": float(word.start), "end": float(word.end)}
+            )
+    return wordlevel_info
+
+
+def transcribe_clips(audio_items, config=None):
+    # Transcribe a queue of clips (media paths) with the shared model, decoding
+    # each one in its worker thread. Returns a list of (item, words, error) in
+    # input order, a failed clip does not stop the rest.
+    audio_items = list(audio_items)
+    if not audio_items:
+        return []
+    get_model(config)
+    concurrency = max(1, get_whisper_config(config)["concurrency"])
+
+    def run(audio):
+        try:
+            return audio, transcribe(audio, config), None
+        except Exception as e:
+            return audio, None, e
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(audio_items))) as executor:
+        return list(executor.map(metrics.bind(run), audio_items))
+
+
+def save_word_timeline(timeline_path, wordlevel_info):
+    # Columnar word timeline, sorted by start time for binary search. Written
+    # to a temporary file first, a killed run never leaves a partial timeline.
+    wordlevel_info = sorted(wordlevel_info, key=lambda word: word["start"])
+    os.makedirs(os.path.dirname(timeline_path), exist_ok=True)
+    tmp_path = f"{timeline_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(
+            f,
+            words=np.array([word["word"] for word in wordlevel_info], dtype=str),
+            starts=np.array([word["start"] for word in wordlevel_info], dtype=np.float32),
+            ends=np.array([word["end"] for word in wordlevel_info], dtype=np.float32),
+        )
+    os.replace(tmp_path, timeline_path)
+
+
+def load_word_timeline(timeline_path):
+    with np.load(timeline_path) as data:
+        return {key: data[key] for key in ("words", "starts", "ends")}
+
+
+def transcribe_source(video_path, timeline_key, config=None):
+    # Transcribe the full source video once, later runs reuse the cached
+    # timeline
+    timeline_path = lookup("timelines", timeline_key, ".npz")
+    if timeline_path is not None:
+        try:
+            return load_word_timeline(timeline_path)
+        except Exception as e:
+            print(f"Ignoring unreadable timeline {timeline_path}: {e}")
+    print(f"Transcribing source video {video_path}")
+    timeline_path = entry_path("timelines", timeline_key, ".npz")
+    save_word_timeline(timeline_path, transcribe(video_path, config))
+    return load_word_timeline(timeline_path)
+
+
+def slice_word_timeline(timeline, start_time, end_time):
+    # Words starting inside [start_time, end_time), rebased to clip time
+    first = int(np.searchsorted(timeline["starts"], start_time, side="left"))
+    last = int(np.searchsorted(timeline["starts"], end_time, side="left"))
+    wordlevel_info = []
+    for index in range(first, last):
+        wordlevel_info.append(
+            {
+                "word": str(timeline["words"][index]),
+                "start": float(timeline["starts"][index]) - start_time,
+                "end": min(float(timeline["ends"][index]), end_time) - start_time,
+            }
+        )
+    return wordlevel_info
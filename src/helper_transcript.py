@@ -0,0 +1,116 @@
+import re
+import bisect
+import importlib.util
+
+# Transcript compaction for the LLM prompt. YouTube captions come as short
+# fragments with float timestamps, most of the prompt tokens go to
+# timestamps the model does not need. Fragments are merged into sentence
+# sized spans starting on whole seconds, filler can be dropped, and the clip
+# times the model returns are snapped back onto the original fragment
+# boundaries.
+
+DEFAULT_MAX_SPAN_SECONDS = 20
+DEFAULT_MAX_SPAN_CHARS = 300
+SENTENCE_END = re.compile(r"[.!?]['\"]?$")
+FILLER = re.compile(
+    r"\[(?:music|applause|laughter|inaudible)\]|\b(?:um+|uh+|uhm|erm|hmm+|ah+)\b[,.]?",
+    re.IGNORECASE,
+)
+
+
+def format_transcript(transcript):
+    return "\n".join([f"{item['start']} - {item['text']}" for item in transcript])
+
+
+def tokens_exact():
+    # Whether count_tokens counts with tiktoken or only estimates
+    return importlib.util.find_spec("tiktoken") is not None
+
+
+def count_tokens(text):
+    # Exact with tiktoken, otherwise estimated at about four characters per
+    # token
+    if not tokens_exact():
+        return (len(text) + 3) // 4
+    import tiktoken
+
+    return len(tiktoken.get_encoding("cl100k_base").encode(text))
+
+
+def clean_text(text, drop_filler=False):
+    text = text.replace("\n", " ")
+    if drop_filler:
+        text = FILLER.sub("", text)
+    return " ".join(text.split())
+
+
+def compact_transcript(
+    transcript,
+    max_span_seconds=DEFAULT_MAX_SPAN_SECONDS,
+    max_span_chars=DEFAULT_MAX_SPAN_CHARS,
+    drop_filler=False,
+):
+    # Spans keep the {"text", "start", "duration"} shape of the fragments,
+    # with start floored to whole seconds. A span ends at the end of a
+    # sentence or once it gets too long.
+    spans = []
+    span = None
+    for item in transcript:
+        text = clean_text(item["text"], drop_filler)
+        if not text:
+            continue
+        end = item["start"] + item.get("duration", 0)
+        if span is not None and (
+            SENTENCE_END.search(span["text"])
+            or item["start"] - span["first"] > max_span_seconds
+            or len(span["text"]) + len(text) > max_span_chars
+        ):
+            spans.append(span)
+            span = None
+        if span is None:
+            span = {"text": text, "first": item["start"], "end": end}
+        else:
+            span["text"] += " " + text
+            span["end"] = max(span["end"], end)
+    if span is not None:
+        spans.append(span)
+
+    return [
+        {
+            "text": span["text"],
+            "start": int(span["first"]),
+            "duration": int(round(span["end"] - int(span["first"]))),
+        }
+        for span in spans
+    ]
+
+
+def nearest(values, t):
+    index = bisect.bisect_left(values, t)
+    return min(values[max(index - 1, 0):index + 1], key=lambda value: abs(value - t))
+
+
+def snap_start(starts, t):
+    # Span starts are floored, the fragment a span starts with begins in
+    # [t, t + 1)
+    index = bisect.bisect_left(starts, t)
+    if index < len(starts) and starts[index] < t + 1:
+        return starts[index]
+    return nearest(starts, t)
+
+
+def snap_clip_times(clips, transcript):
+    # Move clip starts onto fragment starts and clip ends onto the nearest
+    # fragment end of the original transcript
+    starts = sorted(item["start"] for item in transcript)
+    ends = sorted(item["start"] + item.get("duration", 0) for item in transcript)
+    if not starts:
+        return clips
+
+    for clip in clips:
+        start_time = snap_start(starts, clip["start_time"])
+        end_time = nearest(ends, clip["end_time"])
+        if end_time > start_time:
+            clip["start_time"] = round(start_time, 2)
+            clip["end_time"] = round(end_time, 2)
+    return clips
@@ -0,0 +1,56 @@
+import os
+
+# Output variants render the same clip at other sizes or with other captions
+# from one decode of the clip. config["output_variants"] is a list of
+# overrides of the config's own output settings:
+#
+#   [{},
+#    {"name": "square", "output_resolution": "720p", "video_aspect_ratio": [1, 1]},
+#    {"name": "preview", "video_aspect_ratio": [16, 9], "font_config_id": "2"}]
+#
+# The unnamed variant writes to output/<name>/final like a config without
+# variants, a named one to output/<name>/final/<variant name>.
+
+VARIANT_KEYS = ("output_resolution", "video_aspect_ratio", "font_config_id", "encoder_config")
+
+
+def get_variant_specs(config):
+    return config.get("output_variants") or [{}]
+
+
+def get_output_variants(config):
+    # [(variant name or None, config of the variant)]
+    variants = []
+    for spec in get_variant_specs(config):
+        unknown = set(spec) - set(VARIANT_KEYS) - {"name"}
+        if unknown:
+            raise ValueError(f"Unknown output variant keys: {sorted(unknown)}")
+        name = spec.get("name")
+        if name is not None and (not name or os.path.basename(name) != name):
+            raise ValueError(f"Output variant names must be directory names: {name!r}")
+        variant_config = dict(config, output_variants=None)
+        variant_config.update((key, spec[key]) for key in VARIANT_KEYS if key in spec)
+        variants.append((name, variant_config))
+
+    names = [name for name, _ in variants]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        # They would write to the same files
+        raise ValueError(f"Duplicate output variants: {sorted(duplicates, key=str)}")
+    return variants
+
+
+def select_variants(config, names):
+    # config rendering only the variants in names
+    return dict(
+        config,
+        output_variants=[
+            spec for spec in get_variant_specs(config) if spec.get("name") in names
+        ],
+    )
+
+
+def get_variant_path(base_path, name, video_name):
+    if name is None:
+        return os.path.join(base_path, video_name)
+    return os.path.join(base_path, name, video_name)
@@ -0,0 +1,334 @@
+import os
+import time
+import threading
+import subprocess
+from fractions import Fraction
+
+import ffmpeg
+import numpy as np
+from PIL import Image
+
+import helper_metrics as metrics
+
+# Mp4 compatible audio codecs that can be stream copied from the source clip
+COPYABLE_AUDIO_CODECS = ("aac", "mp3", "alac")
+
+
+def probe_video(video_path):
+    metrics.count("ffmpeg_processes")
+    probe = ffmpeg.probe(video_path)
+    video = next(s for s in probe["streams"] if s["codec_type"] == "video")
+    audio = next((s for s in probe["streams"] if s["codec_type"] == "audio"), None)
+    frame_rate = video.get("avg_frame_rate", "0/0")
+    if frame_rate in ("0/0", "0"):
+        frame_rate = video.get("r_frame_rate", "24/1")
+    return {
+        "width": int(video["width"]),
+        "height": int(video["height"]),
+        "frame_rate": frame_rate,
+        "fps": float(Fraction(frame_rate)),
+        "duration": float(probe["format"].get("duration", 0)),
+        "audio_codec": audio["codec_name"] if audio else None,
+    }
+
+
+def get_output_geometry(width, height, output_resolution, video_aspect_ratio):
+    # Scale to the output height, then crop the centre to the aspect ratio
+    target_height = int(output_resolution.split("p")[0])
+    scale_factor = target_height / height
+    scaled_width = int(round(width * scale_factor))
+
+    new_width = int(target_height * video_aspect_ratio[0] / video_aspect_ratio[1])
+    new_width = min(new_width, scaled_width)
+    if new_width % 2 != 0:
+        new_width -= 1
+
+    x_offset = (scaled_width - new_width) // 2
+    if x_offset % 2 != 0:
+        x_offset -= 1
+
+    return {
+        "scaled_width": scaled_width,
+        "scaled_height": target_height,
+        "x_offset": x_offset,
+        "width": new_width,
+        "height": target_height,
+    }
+
+
+def resize_and_crop(frame, geometry, out=None):
+    # out, a (height, width, 3) uint8 array, is filled and returned instead
+    # of a new frame
+    image = Image.fromarray(frame).resize(
+        (geometry["scaled_width"], geometry["scaled_height"]), Image.BICUBIC
+    )
+    x_offset = geometry["x_offset"]
+    frame = np.asarray(image)[:, x_offset : x_offset + geometry["width"]]
+    if out is None:
+        return np.ascontiguousarray(frame)
+    np.copyto(out, frame)
+    return out
+
+
+def get_crop_box(info, geometry):
+    # The same crop and scale as resize_and_crop, but cropping first in source
+    # pixels so ffmpeg only scales the part of the frame that is kept
+    scale_factor = geometry["scaled_height"] / info["height"]
+    crop_width = min(int(round(geometry["width"] / scale_factor)), info["width"])
+    crop_x = min(
+        int(round(geometry["x_offset"] / scale_factor)), info["width"] - crop_width
+    )
+    return crop_width, info["height"], crop_x, 0
+
+
+def get_scale_filter(info, geometry):
+    crop_width, crop_height, crop_x, crop_y = get_crop_box(info, geometry)
+    return (
+        f"crop={crop_width}:{crop_height}:{crop_x}:{crop_y},"
+        f"scale={geometry['width']}:{geometry['height']}:flags=bicubic"
+    )
+
+
+def get_encoder_config(config, info):
+    encoder_config = config.get("encoder_config", {})
+    fps = encoder_config.get("fps") or info["frame_rate"]
+    return {
+        "preset": encoder_config.get("preset", "medium"),
+        "crf": encoder_config.get("crf", 23),
+        "threads": encoder_config.get("threads", 0),
+        "fps": str(fps),
+    }
+
+
+def open_decoder(video_path, video_filter=None):
+    command = ["ffmpeg", "-v", "error", "-i", video_path]
+    if video_filter:
+        command += ["-vf", video_filter]
+    command += ["-f", "rawvideo", "-pix_fmt", "rgb24", "-an", "-"]
+    metrics.count("ffmpeg_processes")
+    return subprocess.Popen(command, stdout=subprocess.PIPE)
+
+
+def open_split_decoder(video_path, video_filters):
+    # One decode split into a filter chain per output, each written as raw
+    # frames to its own pipe. Returns the process and the read ends.
+    pipes = [os.pipe() for _ in video_filters]
+    labels = "".join(f"[v{index}]" for index in range(len(video_filters)))
+    graph = [f"[0:v]split={len(video_filters)}{labels}"]
+    for index, video_filter in enumerate(video_filters):
+        graph.append(f"[v{index}]{video_filter or 'null'}[out{index}]")
+    command = ["ffmpeg", "-v", "error", "-nostdin", "-i", video_path]
+    command += ["-filter_complex", ";".join(graph)]
+    for index, (_, write_fd) in enumerate(pipes):
+        command += [
+            "-map", f"[out{index}]",
+            "-f", "rawvideo",
+            "-pix_fmt", "rgb24",
+            f"pipe:{write_fd}",
+        ]
+    metrics.count("ffmpeg_processes")
+    process = subprocess.Popen(command, pass_fds=[write_fd for _, write_fd in pipes])
+    streams = []
+    for read_fd, write_fd in pipes:
+        os.close(write_fd)
+        streams.append(os.fdopen(read_fd, "rb"))
+    return process, streams
+
+
+def read_frames(stream, width, height):
+    # Frames are read into one preallocated buffer, consumers must be done
+    # with a frame before asking for the next one
+    frame_bytes = width * height * 3
+    buffer = bytearray(frame_bytes)
+    view = memoryview(buffer)
+    frame = np.frombuffer(buffer, dtype=np.uint8).reshape(height, width, 3)
+    while True:
+        read = 0
+        while read < frame_bytes:
+            count = stream.readinto(view[read:])
+            if not count:
+                return
+            read += count
+        yield frame
+
+
+def open_encoder(output_path, width, height, encoder_config, audio_source=None, audio_codec=None):
+    command = [
+        "ffmpeg",
+        "-y",
+        "-v", "error",
+        "-f", "rawvideo",
+        "-pix_fmt", "rgb24",
+        "-s", f"{width}x{height}",
+        "-r", encoder_config["fps"],
+        "-i", "-",
+    ]
+    if audio_source and audio_codec:
+        command += ["-i", audio_source, "-map", "0:v:0", "-map", "1:a:0"]
+        if audio_codec in COPYABLE_AUDIO_CODECS:
+            command += ["-c:a", "copy"]
+        else:
+            command += ["-c:a", "aac"]
+        command += ["-shortest"]
+    command += [
+        "-c:v", "libx264",
+        "-preset", encoder_config["preset"],
+        "-crf", str(encoder_config["crf"]),
+        "-pix_fmt", "yuv420p",
+    ]
+    if encoder_config["threads"]:
+        command += ["-threads", str(encoder_config["threads"])]
+    command += ["-movflags", "+faststart", output_path]
+    metrics.count("ffmpeg_processes")
+    return subprocess.Popen(command, stdin=subprocess.PIPE)
+
+
+def _wait(process, command_name):
+    returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command_name)
+
+
+def get_frame_filter(config, info, video_filter=None):
+    filters = [video_filter] if video_filter else []
+    if config.get("encoder_config", {}).get("fps"):
+        filters.append(f"fps={get_encoder_config(config, info)['fps']}")
+    return ",".join(filters)
+
+
+def encode_frames(frames, output_path, process_frame, encoder_config, video_path, audio_codec):
+    # Pass every frame through process_frame(frame, t) into a libx264
+    # encoder that muxes the audio of video_path, returns the number of
+    # frames written
+    fps = float(Fraction(encoder_config["fps"]))
+    encoder = None
+    count = 0
+    try:
+        for frame in frames:
+            frame = process_frame(frame, count / fps)
+            if encoder is None:
+                encoder = open_encoder(
+                    output_path,
+                    frame.shape[1],
+                    frame.shape[0],
+                    encoder_config,
+                    audio_source=video_path,
+                    audio_codec=audio_codec,
+                )
+            encoder.stdin.write(memoryview(np.ascontiguousarray(frame)))
+            count += 1
+    except BaseException:
+        if encoder is not None:
+            encoder.kill()
+        raise
+    finally:
+        if encoder is not None:
+            encoder.stdin.close()
+    if encoder is not None:
+        _wait(encoder, "ffmpeg encoder")
+    return count
+
+
+def get_render_stats(output_path, frames, elapsed):
+    metrics.count("frames_rendered", frames)
+    stats = {
+        "frames": frames,
+        "seconds": elapsed,
+        "fps": frames / elapsed if elapsed else 0.0,
+    }
+    print(
+        f"Rendered {frames} frames in {elapsed:.1f}s ({stats['fps']:.1f} fps): {output_path}"
+    )
+    return stats
+
+
+def render_frames(video_path, output_path, process_frame, config, video_filter=None, frame_size=None):
+    # Decode video_path with ffmpeg, pass every frame through
+    # process_frame(frame, t) and pipe the result into a libx264 encoder that
+    # muxes the original audio. frame_size is the decoded size after
+    # video_filter, the output size is taken from the first processed frame.
+    info = probe_video(video_path)
+    width, height = frame_size or (info["width"], info["height"])
+
+    decoder = open_decoder(video_path, get_frame_filter(config, info, video_filter))
+    started = time.time()
+    try:
+        frames = encode_frames(
+            read_frames(decoder.stdout, width, height),
+            output_path,
+            process_frame,
+            get_encoder_config(config, info),
+            video_path,
+            info["audio_codec"],
+        )
+    except BaseException:
+        decoder.kill()
+        raise
+    finally:
+        decoder.stdout.close()
+    _wait(decoder, "ffmpeg decoder")
+    if not frames:
+        raise ValueError(f"No frames decoded from {video_path}")
+    return get_render_stats(output_path, frames, time.time() - started)
+
+
+def render_frames_split(video_path, outputs):
+    # render_frames for several outputs from a single decode. outputs are
+    # dicts with the render_frames arguments output_path, process_frame,
+    # config, video_filter and frame_size. ffmpeg splits the decoded video
+    # into a filter chain and pipe per output, every output is processed on
+    # its own thread and encoded by its own ffmpeg process. Returns the
+    # stats of every output.
+    info = probe_video(video_path)
+    decoder, streams = open_split_decoder(
+        video_path,
+        [
+            get_frame_filter(output["config"], info, output.get("video_filter"))
+            for output in outputs
+        ],
+    )
+    started = time.time()
+    frames = [0] * len(outputs)
+    errors = []
+
+    def run(index):
+        output = outputs[index]
+        width, height = output.get("frame_size") or (info["width"], info["height"])
+        try:
+            frames[index] = encode_frames(
+                read_frames(streams[index], width, height),
+                output["output_path"],
+                output["process_frame"],
+                get_encoder_config(output["config"], info),
+                video_path,
+                info["audio_codec"],
+            )
+        except BaseException as e:
+            errors.append(e)
+            # The decoder would block on this output's pipe, stop it so the
+            # other outputs reach the end of their frames
+            decoder.kill()
+        finally:
+            streams[index].close()
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(len(outputs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        decoder.wait()
+        # The decoder was stopped part way, so every output is truncated,
+        # including those whose encoder finished without an error
+        for output in outputs:
+            if os.path.exists(output["output_path"]):
+                os.remove(output["output_path"])
+        raise errors[0]
+    _wait(decoder, "ffmpeg decoder")
+    if not all(frames):
+        raise ValueError(f"No frames decoded from {video_path}")
+    elapsed = time.time() - started
+    return [
+        get_render_stats(output["output_path"], count, elapsed)
+        for output, count in zip(outputs, frames)
+    ]
@@ -1,17 +1,45 @@
-from helper_download import get_clips
-from helper_subtitle import add_subtitles_to_clips
+import time
+import argparse
 import json
 
-with open("./config.json") as f:
-    configs = json.load(f)
+import helper_metrics as metrics
 
-config = configs["1"]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_id", nargs="?", default="1")
+    parser.add_argument(
+        "--subtitles-only",
+        action="store_true",
+        help="Only subtitle the clips already in output/<name>/clips",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="JSONL file for spans and counters, - to print them",
+    )
+    args = parser.parse_args()
 
-print(config)
+    with open("./config.json") as f:
+        configs = json.load(f)
 
-get_clips(config)
+    config = configs[args.config_id]
 
-add_subtitles_to_clips(config)
+    print(config)
 
+    started_at = time.time()
+    metrics.configure(args.metrics)
 
+    with metrics.job(config.get("name")):
+        # Imported here so a subtitle-only rerun never loads the download stack
+        if not args.subtitles_only:
+            from helper_download import get_clips
 
+            get_clips(config)
+
+        from helper_subtitle import add_subtitles_to_clips
+
+        add_subtitles_to_clips(config)
+
+    if args.metrics and args.metrics != "-":
+        metrics.print_summary(
+            metrics.summarize(metrics.load_events(args.metrics, since=started_at))
+        )
@@ -1,3 +1,4 @@
-from faster_whisper import WhisperModel
-model_size = "medium"
-model = WhisperModel(model_size)
+from helper_transcribe import get_model
+
+# Download and cache the default Whisper model at image build time
+get_model()
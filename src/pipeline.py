@@ -0,0 +1,293 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import helper_metrics as metrics
+from helper_cache import hash_key
+from helper_download import plan_clips, download_clips
+
+# Runs many videos through the pipeline at once. The network bound stages
+# (transcript and LLM, download) run in threads under asyncio, each with its
+# own concurrency limit. Rendering runs in a separate process per video, fed
+# through a bounded queue: video N+1 downloads while video N renders, and at
+# most queue_size downloaded videos wait for a renderer.
+#
+# Render processes are started with spawn from a parent that only ever ran
+# network code, so they never inherit locks held by download threads, and they
+# are not daemonic, so add_subtitles_to_clips can start its own worker pool.
+#
+# Progress is written to a state file after every stage. A rerun skips
+# finished jobs and resumes downloaded ones at the render stage, everything
+# else is cheap to redo thanks to the artifact cache.
+#
+# Every process appends its spans and counters to one metrics file, the
+# per-job breakdown of a run is stored with the job state.
+
+STAGES = ("plan", "download", "render")
+DEFAULT_STATE_PATH = os.path.join(os.getcwd(), "output", "pipeline_state.json")
+DEFAULT_METRICS_PATH = os.path.join(os.getcwd(), "output", "metrics.jsonl")
+
+
+def load_jobs(config_path="config.json", jobs_path=None, only=None):
+    # (job id, config) pairs from config.json or from a JSONL queue with one
+    # config per line
+    jobs = []
+    if jobs_path:
+        with open(jobs_path) as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                config = json.loads(line)
+                jobs.append((str(config.get("id", config.get("name", number))), config))
+    else:
+        with open(config_path) as f:
+            jobs = list(json.load(f).items())
+    if only:
+        jobs = [job for job in jobs if job[0] in only]
+
+    names = [config.get("name") for _, config in jobs]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        # Jobs with the same name would write to the same output directory
+        raise ValueError(f"Duplicate job names: {sorted(duplicates)}")
+    return jobs
+
+
+def load_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def save_state(state_path, state):
+    os.makedirs(os.path.dirname(state_path) or ".", exist_ok=True)
+    tmp_path = f"{state_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_path, state_path)
+
+
+def render_job(config, connection, job_id=None, metrics_path=None):
+    # Imported here so the parent never loads the render and Whisper stack
+    from helper_subtitle import add_subtitles_to_clips
+
+    # A spawned process starts without the parent's sinks
+    metrics.configure(metrics_path)
+    try:
+        with metrics.job(job_id):
+            records = add_subtitles_to_clips(config)
+        failed = sum(1 for record in records if record["status"] != "ok")
+        if failed:
+            result = {"status": "failed", "error": f"{failed}/{len(records)} clips failed"}
+        else:
+            result = {"status": "ok", "clips": len(records)}
+    except Exception as e:
+        result = {
+            "status": "failed",
+            "error": f"{type(e).__name__}: {e}",
+            "traceback": traceback.format_exc(),
+        }
+    connection.send(result)
+    connection.close()
+
+
+def run_render_process(config, job_id=None, metrics_path=None):
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(
+        target=render_job, args=(config, sender, job_id, metrics_path)
+    )
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        result = {"status": "crashed", "error": f"Render exited with code {process.exitcode}"}
+    return result
+
+
+async def run_pipeline(
+    jobs,
+    state_path=DEFAULT_STATE_PATH,
+    plan_concurrency=4,
+    download_concurrency=2,
+    render_processes=1,
+    queue_size=1,
+    force=False,
+    metrics_path=DEFAULT_METRICS_PATH,
+):
+    loop = asyncio.get_running_loop()
+    state = load_state(state_path)
+    started_at = time.time()
+    sink = metrics.configure(metrics_path)
+    limits = {
+        "plan": asyncio.Semaphore(plan_concurrency),
+        "download": asyncio.Semaphore(download_concurrency),
+    }
+    # A download only starts when its video will have a place in the queue or
+    # a renderer, so downloads never run more than queue_size videos ahead
+    slots = asyncio.Semaphore(queue_size + render_processes)
+    render_queue = asyncio.Queue(maxsize=queue_size)
+    io_executor = ThreadPoolExecutor(max_workers=plan_concurrency + download_concurrency)
+    render_executor = ThreadPoolExecutor(max_workers=render_processes)
+
+    def update(job_id, **fields):
+        state[job_id].update(fields, updated=time.time())
+        save_state(state_path, state)
+
+    def complete(job_id, stage, seconds):
+        job = state[job_id]
+        update(
+            job_id,
+            completed=[done for done in job["completed"] if done != stage] + [stage],
+            seconds=dict(job["seconds"], **{stage: round(seconds, 2)}),
+        )
+        print(f"[{job_id}] {stage} finished in {seconds:.1f}s")
+
+    async def run_stage(job_id, stage, function, *args):
+        async with limits[stage]:
+            print(f"[{job_id}] {stage} started")
+            started = time.time()
+            result = await loop.run_in_executor(
+                io_executor, metrics.bind(function, job_id), *args
+            )
+        complete(job_id, stage, time.time() - started)
+        return result
+
+    async def prepare(job_id, config):
+        await slots.acquire()
+        try:
+            if "download" not in state[job_id]["completed"]:
+                plan = await run_stage(job_id, "plan", plan_clips, config)
+                await run_stage(job_id, "download", download_clips, config, plan)
+        except Exception as e:
+            slots.release()
+            print(f"[{job_id}] failed: {e}")
+            update(job_id, status="failed", error=f"{type(e).__name__}: {e}")
+            return
+        await render_queue.put((job_id, config))
+
+    async def render():
+        while True:
+            item = await render_queue.get()
+            if item is None:
+                break
+            job_id, config = item
+            print(f"[{job_id}] render started")
+            started = time.time()
+            try:
+                result = await loop.run_in_executor(
+                    render_executor, run_render_process, config, job_id, metrics_path
+                )
+            except Exception as e:
+                result = {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+            finally:
+                slots.release()
+            if result["status"] == "ok":
+                complete(job_id, "render", time.time() - started)
+                update(job_id, status="done", error=None)
+            else:
+                print(f"[{job_id}] render {result['status']}: {result['error']}")
+                update(job_id, status="failed", error=result["error"])
+
+    pending = []
+    for job_id, config in jobs:
+        config_key = hash_key("job", config)
+        job = state.get(job_id)
+        if job is None or job.get("config_key") != config_key or force:
+            job = state[job_id] = {"completed": [], "seconds": {}}
+        elif job["status"] == "done":
+            print(f"[{job_id}] already done, skipping")
+            continue
+        job.update(name=config.get("name"), config_key=config_key, status="running", error=None)
+        pending.append((job_id, config))
+    save_state(state_path, state)
+
+    renderers = [asyncio.ensure_future(render()) for _ in range(render_processes)]
+    try:
+        await asyncio.gather(*(prepare(job_id, config) for job_id, config in pending))
+        for _ in renderers:
+            await render_queue.put(None)
+        await asyncio.gather(*renderers)
+    finally:
+        io_executor.shutdown(wait=False)
+        render_executor.shutdown(wait=False)
+        if sink is not None:
+            metrics.remove_sink(sink)
+
+    print_pipeline_summary(state, [job_id for job_id, _ in jobs])
+    if metrics_path and metrics_path != "-":
+        summary = metrics.summarize(metrics.load_events(metrics_path, since=started_at))
+        summary = {job_id: totals for job_id, totals in summary.items() if job_id in state}
+        for job_id, totals in summary.items():
+            state[job_id]["metrics"] = totals
+        save_state(state_path, state)
+        metrics.print_summary(summary)
+    return state
+
+
+def print_pipeline_summary(state, job_ids):
+    print("Pipeline summary:")
+    for job_id in job_ids:
+        job = state.get(job_id)
+        if job is None:
+            continue
+        seconds = "  ".join(
+            f"{stage} {job['seconds'][stage]:.1f}s" for stage in STAGES if stage in job["seconds"]
+        )
+        line = f"  {job['status']:<8} {job_id} ({job['name']})  {seconds}"
+        if job.get("error"):
+            line += f"  ({job['error']})"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run every job in config.json, or in a JSONL job queue, through the pipeline"
+    )
+    parser.add_argument("--config", default="config.json", help="JSON object of job id to config")
+    parser.add_argument("--jobs", help="JSONL file with one job config per line")
+    parser.add_argument("--only", nargs="+", help="Job ids to run")
+    parser.add_argument("--state", default=DEFAULT_STATE_PATH, help="Job state file")
+    parser.add_argument("--plan-concurrency", type=int, default=4)
+    parser.add_argument("--download-concurrency", type=int, default=2)
+    parser.add_argument("--render-processes", type=int, default=1)
+    parser.add_argument("--queue-size", type=int, default=1)
+    parser.add_argument("--force", action="store_true", help="Rerun finished jobs")
+    parser.add_argument(
+        "--metrics",
+        default=DEFAULT_METRICS_PATH,
+        help="JSONL file for spans and counters, - to print them, empty to turn them off",
+    )
+    args = parser.parse_args(argv)
+
+    jobs = load_jobs(args.config, args.jobs, args.only)
+    state = asyncio.run(
+        run_pipeline(
+            jobs,
+            state_path=args.state,
+            plan_concurrency=args.plan_concurrency,
+            download_concurrency=args.download_concurrency,
+            render_processes=args.render_processes,
+            queue_size=args.queue_size,
+            force=args.force,
+            metrics_path=args.metrics,
+        )
+    )
+    failed = [job_id for job_id, _ in jobs if state[job_id]["status"] != "done"]
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
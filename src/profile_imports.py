@@ -0,0 +1,104 @@
+import os
+import sys
+import tarfile
+import argparse
+import tempfile
+import subprocess
+
+# Import time of the pipeline entry points, each measured in a fresh
+# interpreter with python -X importtime. With --against the same modules are
+# measured in an older revision of src/ too, to compare startup cost.
+#
+#   python profile_imports.py
+#   python profile_imports.py --against HEAD~1 helper_subtitle
+
+DEFAULT_MODULES = ("helper_download", "helper_subtitle", "pipeline", "index")
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_rows(code, directory=SOURCE_DIR):
+    # ([(module, cumulative ms)], error)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=directory,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    rows = []
+    errors = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            errors.append(line)
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        rows.append((parts[2].strip(), int(parts[1]) / 1000))
+    error = None
+    if result.returncode != 0:
+        error = errors[-1] if errors else f"exit code {result.returncode}"
+    return rows, error
+
+
+def profile_import(module, directory=SOURCE_DIR, baseline=()):
+    # Returns {"module", "ms", "heaviest": [(name, ms)], "error"}. Modules in
+    # baseline are loaded by the interpreter itself and not reported.
+    rows, error = import_rows(f"import {module}", directory)
+    profile = {"module": module, "ms": None, "heaviest": [], "error": error}
+    if error:
+        return profile
+    profile["ms"] = dict(rows).get(module)
+    # Top level packages only, their submodules are part of their time
+    profile["heaviest"] = sorted(
+        (
+            (name, ms)
+            for name, ms in rows
+            if "." not in name and name != module and name not in baseline
+        ),
+        key=lambda row: -row[1],
+    )[:8]
+    return profile
+
+
+def export_revision(revision, directory):
+    # src/ of an older revision, for before and after numbers
+    repository = os.path.dirname(SOURCE_DIR)
+    archive = os.path.join(directory, "src.tar")
+    with open(archive, "wb") as f:
+        subprocess.run(
+            ["git", "archive", revision, "src"], cwd=repository, stdout=f, check=True
+        )
+    with tarfile.open(archive) as tar:
+        tar.extractall(directory)
+    return os.path.join(directory, "src")
+
+
+def print_profile(label, profile):
+    if profile["error"]:
+        print(f"{label:<8} {profile['module']:<18} failed: {profile['error']}")
+        return
+    print(f"{label:<8} {profile['module']:<18} {profile['ms']:8.1f} ms")
+    for name, ms in profile["heaviest"]:
+        print(f"{'':<28}{ms:8.1f} ms  {name}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the import time of pipeline modules")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--against", help="git revision to compare with")
+    args = parser.parse_args(argv)
+
+    baseline = {name for name, _ in import_rows("pass")[0]}
+    with tempfile.TemporaryDirectory() as directory:
+        before_directory = export_revision(args.against, directory) if args.against else None
+        for module in args.modules:
+            if before_directory:
+                print_profile("before", profile_import(module, before_directory, baseline))
+            print_profile(
+                "after" if before_directory else "", profile_import(module, SOURCE_DIR, baseline)
+            )
+
+
+if __name__ == "__main__":
+    main()
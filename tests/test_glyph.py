@@ -0,0 +1,38 @@
+import threading
+
+import numpy as np
+
+import helper_glyph
+
+
+def test_concurrent_cold_cache_writes(tmp_path, monkeypatch):
+    # Split renders build the same new words on one thread per variant
+    monkeypatch.setattr(helper_glyph, "GLYPH_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(helper_glyph, "resolve_font_path", lambda font: font)
+    monkeypatch.setattr(
+        helper_glyph,
+        "_rasterize_word",
+        lambda text, style: np.full((4, len(text), 4), 255, dtype=np.uint8),
+    )
+    render_word = helper_glyph.render_word.__wrapped__
+    style = ("Font", 40, "white", "black", 2)
+    words = [f"word{index}" for index in range(50)]
+    barrier = threading.Barrier(4)
+    errors = []
+
+    def run():
+        barrier.wait()
+        for word in words:
+            try:
+                assert render_word(word, style).shape == (4, len(word), 4)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(list(tmp_path.glob("*/*.npy"))) == len(words)
+    assert list(tmp_path.glob("*/*.tmp")) == []
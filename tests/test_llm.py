@@ -0,0 +1,182 @@
+import json
+import time
+import threading
+
+import pytest
+
+import helper_cache
+import helper_llm
+from helper_llm import clip_overlap, get_completion, mock_complete
+
+helper_download = pytest.importorskip("helper_download")
+
+MOCK_CONFIG = {"service": "mock", "model": "mock"}
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(helper_cache, "CACHE_DIR", str(tmp_path / ".cache"))
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    # Messages that reached the model, answered by the mock service
+    messages = []
+
+    def complete(message, service="gemini", model="", base_url=None):
+        messages.append(message)
+        time.sleep(0.05)
+        return mock_complete(message)
+
+    monkeypatch.setattr(helper_llm, "complete", complete)
+    return messages
+
+
+def fake_replies(monkeypatch, replies):
+    # Answers the first prompt and then each retry with the next reply
+    messages = []
+
+    def complete(message, service="gemini", model="", base_url=None):
+        messages.append(message)
+        return replies[len(messages) - 1]
+
+    monkeypatch.setattr(helper_llm, "complete", complete)
+    return messages
+
+
+def make_transcript(seconds):
+    return [
+        {"text": f"sentence number {start // 5}", "start": float(start), "duration": 5.0}
+        for start in range(0, seconds, 5)
+    ]
+
+
+def clip(title, start_time, end_time):
+    return {"title": title, "info": "", "why_clip_was_chosen": "", "url": "", "start_time": start_time, "end_time": end_time}
+
+
+def test_request_clips_mock():
+    transcript = make_transcript(600)
+    message = helper_download.get_message(transcript)
+    clips, outputs = helper_download.request_clips(message, MOCK_CONFIG, 600)
+    assert [c["start_time"] for c in clips] == [0, 120, 240, 360, 480]
+    assert all(c["end_time"] - c["start_time"] == 30 for c in clips)
+    assert len(outputs) == 1
+
+
+def test_request_clips_is_cached(calls):
+    message = helper_download.get_message(make_transcript(600))
+    first = helper_download.request_clips(message, MOCK_CONFIG, 600)
+    second = helper_download.request_clips(message, MOCK_CONFIG, 600)
+    assert first == second
+    assert len(calls) == 1
+
+
+def test_request_clips_retries_invalid_clips(monkeypatch):
+    messages = fake_replies(
+        monkeypatch,
+        [
+            json.dumps([clip("Good", 0, 30), clip("Short", 100, 105)]),
+            json.dumps([clip("Short", 100, 130)]),
+        ],
+    )
+    clips, outputs = helper_download.request_clips("prompt", MOCK_CONFIG, 600)
+    assert [(c["title"], c["start_time"], c["end_time"]) for c in clips] == [
+        ("Good", 0, 30),
+        ("Short", 100, 130),
+    ]
+    assert len(outputs) == 2
+    # Only the invalid clip is asked for again
+    assert "Short" in messages[1] and "Good" not in messages[1].split("invalid:")[1]
+
+
+def test_request_clips_retries_unusable_output(monkeypatch):
+    messages = fake_replies(
+        monkeypatch, ["Sorry, I cannot help with that.", json.dumps([clip("Good", 0, 30)])]
+    )
+    clips, outputs = helper_download.request_clips("prompt", MOCK_CONFIG, 600)
+    assert [c["title"] for c in clips] == ["Good"]
+    assert "could not be used" in messages[1]
+
+
+def test_request_clips_gives_up_after_retries(monkeypatch):
+    fake_replies(monkeypatch, ["no json", "still no json"])
+    clips, outputs = helper_download.request_clips("prompt", MOCK_CONFIG, 600)
+    assert clips == []
+    assert len(outputs) == 2
+
+
+def test_extract_clips_chunked_mock(calls):
+    config = dict(MOCK_CONFIG, llm_window_seconds=600, llm_window_overlap=60)
+    messages, outputs, clips = helper_download.extract_clips_chunked(
+        make_transcript(1500), config, 1500
+    )
+    assert len(messages) == len(outputs) == len(calls) == 3
+    starts = [c["start_time"] for c in clips]
+    assert starts == sorted(starts)
+    for a, b in zip(clips, clips[1:]):
+        assert clip_overlap(a, b) <= helper_llm.DUPLICATE_OVERLAP
+
+
+def test_identical_prompts_are_coalesced(calls):
+    # Jobs of the same video send the same window prompts at the same time
+    config = dict(MOCK_CONFIG, llm_window_seconds=600, llm_window_overlap=60)
+    transcript = make_transcript(1500)
+    barrier = threading.Barrier(4)
+    results = []
+
+    def run():
+        barrier.wait()
+        results.append(helper_download.extract_clips_chunked(transcript, config, 1500))
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 4
+    assert all(result == results[0] for result in results)
+    assert sorted(calls) == sorted(results[0][0])
+
+
+def test_coalesce_shares_one_request(calls):
+    barrier = threading.Barrier(8)
+    outputs = []
+
+    def run():
+        barrier.wait()
+        outputs.append(get_completion("0 - hello", "mock", "mock"))
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert outputs == [outputs[0]] * 8
+
+
+def test_base_url_is_passed_on_and_cached_apart(monkeypatch):
+    base_urls = []
+
+    def complete(message, service="gemini", model="", base_url=None):
+        base_urls.append(base_url)
+        return "[]"
+
+    monkeypatch.setattr(helper_llm, "complete", complete)
+    config = dict(MOCK_CONFIG, llm_base_url="http://localhost:8000/v1")
+    helper_download.request_clips("prompt", MOCK_CONFIG, 600)
+    helper_download.request_clips("prompt", config, 600)
+    helper_download.request_clips("prompt", config, 600)
+    assert base_urls == [None, "http://localhost:8000/v1"]
+
+
+def test_gemini_rejects_a_second_endpoint(monkeypatch):
+    pytest.importorskip("google.generativeai")
+    monkeypatch.setenv("GOOGLE_API_KEY", "test")
+    monkeypatch.setattr(helper_llm, "_clients", {})
+    model = helper_llm.get_gemini_model("gemini-pro")
+    assert helper_llm.get_gemini_model("gemini-pro") is model
+    helper_llm.get_gemini_model("gemini-1.5-flash")
+    with pytest.raises(ValueError):
+        helper_llm.get_gemini_model("gemini-pro", "http://localhost:8000")
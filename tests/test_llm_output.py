@@ -0,0 +1,128 @@
+import json
+
+import pytest
+
+from helper_llm import (
+    check_llm_output,
+    extract_json_array,
+    parse_clip_list,
+    repair_json,
+    unique_titles,
+    validate_clip,
+)
+
+
+def test_extract_json_array_skips_prose_and_brackets_in_strings():
+    text = 'Here you go [see below]: ```json\n[{"title": "a ] b", "x": [1, 2]}]\n``` Done.'
+    assert extract_json_array("Sure! " + text) == "[see below]"
+    assert json.loads(extract_json_array(text.replace("[see below]", ""))) == [
+        {"title": "a ] b", "x": [1, 2]}
+    ]
+
+
+def test_extract_json_array_without_array():
+    with pytest.raises(ValueError):
+        extract_json_array("I could not find any clips.")
+
+
+def test_repair_json_leaves_string_values_alone():
+    text = '[{"title": "x", "info": "note: it\'s fine, see: b", "start_time": 1, "end_time": 30,}]'
+    assert json.loads(repair_json(text)) == [
+        {"title": "x", "info": "note: it's fine, see: b", "start_time": 1, "end_time": 30}
+    ]
+    assert json.loads(repair_json(text, only_commas=True))[0]["info"] == "note: it's fine, see: b"
+
+
+def test_repair_json_fixes_python_style_output():
+    text = "[{title: 'It\\'s \"big\"', start_time: 1, end_time: 30, ok: True, url: None,}, // done\n]"
+    assert json.loads(repair_json(text)) == [
+        {"title": 'It\'s "big"', "start_time": 1, "end_time": 30, "ok": True, "url": None}
+    ]
+
+
+def test_repair_json_smart_quotes_and_urls():
+    text = '[{“title”: “a, b: c”, "url": "http://example.com/a,]", "n": [1, 2,],}]'
+    assert json.loads(repair_json(text)) == [
+        {"title": "a, b: c", "url": "http://example.com/a,]", "n": [1, 2]}
+    ]
+
+
+def test_repair_json_only_commas_keeps_other_text():
+    assert repair_json("[{'a': True,}]", only_commas=True) == "[{'a': True}]"
+
+
+def test_parse_clip_list_rejects_objects():
+    with pytest.raises(ValueError):
+        parse_clip_list('{"title": "a"}')
+
+
+def test_validate_clip_normalises():
+    clip = validate_clip(
+        {"title": "My clip: part 1!", "start_time": "1:05", "end_time": "95.5", "url": None}
+    )
+    assert clip == {
+        "title": "My_clip_part_1",
+        "start_time": 65,
+        "end_time": 95.5,
+        "url": "",
+        "info": "",
+        "why_clip_was_chosen": "",
+    }
+
+
+def test_validate_clip_clamps_to_the_video():
+    clip = validate_clip({"title": "a", "start_time": -3, "end_time": 30}, video_length=100)
+    assert (clip["start_time"], clip["end_time"]) == (0, 30)
+    clip = validate_clip({"title": "a", "start_time": 70, "end_time": 110}, video_length=100)
+    assert (clip["start_time"], clip["end_time"]) == (70, 100)
+
+
+@pytest.mark.parametrize(
+    "clip, reason",
+    [
+        ("not a clip", "not an object"),
+        ({"title": "a", "start_time": 0}, "missing end_time"),
+        ({"title": "", "start_time": 0, "end_time": 30}, "missing title"),
+        ({"title": "a", "start_time": 0, "end_time": 10}, "outside"),
+        ({"title": "a", "start_time": 0, "end_time": 81}, "outside"),
+        ({"title": "a", "start_time": 90, "end_time": 120}, "outside"),
+    ],
+)
+def test_validate_clip_rejects(clip, reason):
+    with pytest.raises(ValueError, match=reason):
+        validate_clip(clip, video_length=100)
+
+
+def test_validate_clip_slack():
+    clip = {"title": "a", "start_time": 0, "end_time": 81}
+    assert validate_clip(clip, slack=2)["end_time"] == 81
+
+
+def test_check_llm_output_does_not_raise_on_negative_start():
+    valid, invalid, error = check_llm_output(
+        '[{"title": "a", "start_time": -3, "end_time": 30}, {"title": "b", "start_time": "x", "end_time": 30}]',
+        100,
+    )
+    assert error is None
+    assert [clip["title"] for clip in valid] == ["a"]
+    assert [clip["title"] for clip, _ in invalid] == ["b"]
+
+
+def test_check_llm_output_drops_overlapping_clips():
+    valid, invalid, error = check_llm_output(
+        json.dumps(
+            [
+                {"title": "a", "start_time": 0, "end_time": 30},
+                {"title": "b", "start_time": 20, "end_time": 50},
+                {"title": "c", "start_time": 30, "end_time": 60},
+            ]
+        )
+    )
+    # The later of two overlapping clips is dropped, it is not worth a retry
+    assert [clip["title"] for clip in valid] == ["a", "c"]
+    assert invalid == []
+
+
+def test_unique_titles():
+    clips = unique_titles([{"title": "Intro"}, {"title": "intro"}, {"title": "Intro"}, {"title": "Other"}])
+    assert [clip["title"] for clip in clips] == ["Intro", "intro_2", "Intro_3", "Other"]
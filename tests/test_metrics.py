@@ -0,0 +1,127 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import helper_metrics as metrics
+
+
+@pytest.fixture
+def events():
+    events = []
+    metrics.add_sink(events.append)
+    yield events
+    metrics.remove_sink(events.append)
+
+
+def render(frames):
+    with metrics.span("render", clip="a.mp4") as fields:
+        fields["frames"] = frames
+    metrics.count("frames_rendered", frames)
+
+
+def test_nothing_is_emitted_without_sinks():
+    assert not metrics.enabled()
+    metrics.count("frames_rendered", 10)
+
+
+def test_span_count_and_event(events):
+    with metrics.job("books"):
+        render(120)
+        metrics.event("clip_failed", stage="cut")
+
+    span, counter, event = events
+    assert span["type"] == "span" and span["status"] == "ok"
+    assert span["job"] == "books" and span["clip"] == "a.mp4" and span["frames"] == 120
+    assert span["seconds"] >= 0
+    assert counter == dict(counter, type="count", name="frames_rendered", value=120, job="books")
+    assert event == dict(event, type="event", name="clip_failed", stage="cut", job="books")
+
+
+def test_failed_span_is_recorded_and_reraised(events):
+    with metrics.job("books"):
+        with pytest.raises(ValueError):
+            with metrics.span("download"):
+                raise ValueError("no stream")
+
+    assert events[0]["status"] == "failed"
+    assert events[0]["error"] == "ValueError: no stream"
+
+
+def test_timed(events):
+    @metrics.timed("cut_clips")
+    def cut():
+        return "done"
+
+    assert cut() == "done"
+    assert [(e["name"], e["status"]) for e in events] == [("cut_clips", "ok")]
+
+
+def test_bind_carries_the_job_to_worker_threads(events):
+    with metrics.job("books"):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(metrics.bind(render), [10, 20]))
+        # Without bind the worker thread has no job
+        thread = threading.Thread(target=render, args=(5,))
+        thread.start()
+        thread.join()
+    assert metrics.current_job() is None
+
+    jobs = [(e["name"], e["job"]) for e in events if e["type"] == "count"]
+    assert sorted(jobs, key=str) == sorted(
+        [("frames_rendered", "books"), ("frames_rendered", "books"), ("frames_rendered", None)],
+        key=str,
+    )
+
+
+def test_summarize_breaks_down_per_job(events):
+    with metrics.job("books"):
+        render(100)
+        render(50)
+        with pytest.raises(RuntimeError):
+            with metrics.span("render"):
+                raise RuntimeError("encoder died")
+        metrics.event("clip_failed", stage="render")
+    with metrics.job("films"):
+        render(30)
+    metrics.count("bytes_downloaded", 2048)
+
+    summary = metrics.summarize(events)
+    assert set(summary) == {"books", "films", None}
+    books = summary["books"]
+    assert books["spans"]["render"]["count"] == 3
+    assert books["spans"]["render"]["failed"] == 1
+    assert books["counters"] == {"frames_rendered": 150}
+    assert books["events"] == {"clip_failed": 1}
+    assert summary["films"]["spans"]["render"] == dict(
+        summary["films"]["spans"]["render"], count=1, failed=0
+    )
+    assert summary["films"]["counters"] == {"frames_rendered": 30}
+    assert summary[None]["counters"] == {"bytes_downloaded": 2048}
+
+
+def test_failing_sink_does_not_break_the_pipeline(events):
+    def broken(event):
+        raise OSError("disk full")
+
+    metrics.add_sink(broken)
+    try:
+        render(1)
+    finally:
+        metrics.remove_sink(broken)
+    assert [e["name"] for e in events] == ["render", "frames_rendered"]
+
+
+def test_jsonl_sink_round_trip(tmp_path):
+    path = str(tmp_path / "metrics.jsonl")
+    sink = metrics.add_sink(metrics.jsonl_sink(path))
+    try:
+        with metrics.job("books"):
+            render(12)
+    finally:
+        metrics.remove_sink(sink)
+    with open(path, "a") as f:
+        # A line cut short by a killed process
+        f.write('{"type": "span", "na')
+    summary = metrics.summarize(metrics.load_events(path))
+    assert summary["books"]["counters"] == {"frames_rendered": 12}
@@ -0,0 +1,139 @@
+import os
+import re
+import shutil
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import helper_cache
+import helper_metrics as metrics
+
+helper_download = pytest.importorskip("helper_download")
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+
+SOURCE_SECONDS = 60
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    # Serves the server's files with byte range support like the YouTube
+    # stream URLs, and records the ranges asked for
+    def do_HEAD(self):
+        self.send(body=False)
+
+    def do_GET(self):
+        self.send(body=True)
+
+    def send(self, body):
+        path = self.server.files.get(self.path.split("?")[0])
+        if path is None:
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1) or 0)
+            self.server.ranges.append((self.path, start / size))
+            end = min(int(match.group(2) or end), end)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if not body:
+            return
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            try:
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 64 * 1024))
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                # ffmpeg closes the connection once it has what it needs
+                pass
+
+    def log_message(self, *args):
+        pass
+
+
+def ffmpeg(*args):
+    subprocess.run(["ffmpeg", "-y", "-loglevel", "error", *args], check=True)
+
+
+def media_info(path):
+    # ffmpeg -i output, ffprobe is not needed
+    result = subprocess.run(["ffmpeg", "-i", path], stderr=subprocess.PIPE, text=True)
+    return result.stderr
+
+
+def duration(info):
+    hours, minutes, seconds = re.search(r"Duration: (\d+):(\d+):([\d.]+)", info).groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    # Adaptive streams like YouTube serves them: video without sound and a
+    # separate audio stream, both with the index at the front
+    directory = tmp_path_factory.mktemp("streams")
+    video = str(directory / "video.mp4")
+    audio = str(directory / "audio.m4a")
+    ffmpeg(
+        "-f", "lavfi", "-i", f"testsrc=size=320x180:rate=25:duration={SOURCE_SECONDS}",
+        "-c:v", "libx264", "-preset", "veryfast", "-g", "50", "-pix_fmt", "yuv420p",
+        "-movflags", "+faststart", video,
+    )
+    ffmpeg(
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={SOURCE_SECONDS}",
+        "-c:a", "aac", "-movflags", "+faststart", audio,
+    )
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    httpd.files = {"/video.mp4": video, "/audio.m4a": audio}
+    httpd.ranges = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_segments_mode_cuts_clip_from_http_source(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(helper_cache, "CACHE_DIR", str(tmp_path / ".cache"))
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setattr(
+        helper_download,
+        "resolve_stream_urls",
+        lambda url, target_height=1080: (f"{base_url}/video.mp4", f"{base_url}/audio.m4a"),
+    )
+    config = {"download_mode": "segments", "cut_mode": "copy", "output_resolution": "180p"}
+    content = {"title": "clip", "start_time": 40, "end_time": 50}
+    server.ranges = []
+    events = []
+    metrics.add_sink(events.append)
+    try:
+        video = helper_download.download_and_trim(
+            "https://www.youtube.com/watch?v=local", str(tmp_path), [content], config=config
+        )
+    finally:
+        metrics.remove_sink(events.append)
+
+    # Nothing was downloaded in full
+    assert video is None
+    clip = str(tmp_path / "clips" / "clip.mp4")
+    info = media_info(clip)
+    assert "Video:" in info and "Audio:" in info
+    assert 9.5 <= duration(info) <= 10.5
+    downloaded = [e["value"] for e in events if e["name"] == "bytes_downloaded"]
+    assert downloaded == [os.path.getsize(clip)]
+    # Both streams were read from a range request near the clip start at
+    # 40 of 60 seconds rather than from the start of the file
+    for path in server.files:
+        assert any(0.5 < offset < 0.8 for requested, offset in server.ranges if requested == path)
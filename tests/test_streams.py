@@ -0,0 +1,58 @@
+import os
+import json
+
+import pytest
+
+from helper_streams import get_target_height, select_streams
+
+# Stream lists recorded from pytube with stream_metadata
+with open(os.path.join(os.path.dirname(__file__), "fixtures", "streams.json")) as f:
+    STREAMS = json.load(f)
+
+
+def itags(selected):
+    return selected["video"]["itag"], selected["audio"] and selected["audio"]["itag"]
+
+
+def test_progressive_only_picks_smallest_covering_stream():
+    assert itags(select_streams(STREAMS["progressive_only"], 720)) == (22, None)
+    assert itags(select_streams(STREAMS["progressive_only"], 360)) == (18, None)
+
+
+def test_progressive_only_below_target_picks_largest():
+    assert itags(select_streams(STREAMS["progressive_only"], 1080)) == (22, None)
+
+
+def test_adaptive_picks_target_height_mp4_and_best_mp4_audio():
+    assert itags(select_streams(STREAMS["adaptive"], 1080)) == (137, 140)
+
+
+def test_adaptive_prefers_lower_frame_rate_at_same_height():
+    assert itags(select_streams(STREAMS["adaptive"], 720)) == (136, 140)
+
+
+def test_adaptive_picks_smallest_stream_above_target():
+    assert itags(select_streams(STREAMS["adaptive"], 1200)) == (271, 140)
+
+
+def test_adaptive_without_target_height_picks_largest():
+    assert itags(select_streams(STREAMS["adaptive_up_to_720p"], 1080)) == (136, 140)
+
+
+def test_without_audio_only_stream_falls_back_to_progressive():
+    assert itags(select_streams(STREAMS["no_audio_only"], 1080)) == (22, None)
+
+
+def test_video_only_streams_have_no_audio():
+    assert itags(select_streams(STREAMS["video_only"], 1080)) == (137, None)
+
+
+def test_no_video_stream():
+    audio_only = [s for s in STREAMS["adaptive"] if not s["video"]]
+    with pytest.raises(ValueError):
+        select_streams(audio_only, 1080)
+
+
+def test_target_height_from_config():
+    assert get_target_height({"output_resolution": "720p"}) == 720
+    assert get_target_height({}) == 1080